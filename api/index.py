@@ -1,35 +1,391 @@
 import os
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, abort, session, send_file, send_from_directory, render_template_string
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
+from flask import Flask, render_template, request, redirect, url_for, abort, session, send_file, send_from_directory, render_template_string, make_response, Response, stream_with_context, has_request_context
+from pymongo import MongoClient, UpdateMany, UpdateOne, ReturnDocument
+from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError, OperationFailure, PyMongoError
+from pymongo import monitoring
+from pymongo.collection import Collection
 import certifi
 from dotenv import load_dotenv
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import Counter, OrderedDict, deque
+from jinja2 import nodes
+from jinja2.ext import Extension
 import json
 from user_agents import parse
 import requests
+from requests.adapters import HTTPAdapter
 import io
 import traceback
 import hmac
 import random
 import sys
 import hashlib
+import re
+import threading
+import copy
+import click
+import zlib
+import difflib
+from html import unescape as unescape_html
+import zipfile
+import time
+import gzip
+import brotli
+import shutil
+import subprocess
+import tempfile
+from bson import json_util, ObjectId
 
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-key-123")
 
+# --- DB PROFILER ---
+# A pymongo CommandListener attributes every command to the route and slug of
+# the request that issued it (sync pymongo reports on the calling thread).
+# Commands are grouped by "shape" (collection, command and filter keys with
+# values stripped) so repeated lookups inside page python_logic show up as
+# N+1 patterns. getMore batches add their time and documents to the command
+# that opened the cursor. Disable with DB_PROFILER=off.
+DB_PROFILER_ENABLED = os.environ.get("DB_PROFILER", "on") != "off"
+DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", "100"))
+DB_N_PLUS_ONE_THRESHOLD = 5
+DB_PROFILE_HISTORY = 200
+DB_PROFILED_COMMANDS = {"find", "aggregate", "count", "distinct", "insert", "update", "delete", "findAndModify", "getMore"}
+DB_OPEN_CURSORS_MAX = 1024
+
+profiler_state = threading.local()
+db_profile = {
+    "shapes": {},
+    "slow": deque(maxlen=DB_PROFILE_HISTORY),
+    "n_plus_one": deque(maxlen=DB_PROFILE_HISTORY)
+}
+db_profile_lock = threading.Lock()
+
+
+def _strip_values(value):
+    """Keeps the key structure of a query and replaces every literal with '?'."""
+    if isinstance(value, dict):
+        return {k: _strip_values(v) for k, v in sorted(value.items())}
+    if isinstance(value, list):
+        return [_strip_values(v) for v in value[:1]]
+    return "?"
+
+
+def _command_shape(name, command):
+    """Describes a command by collection, operation and stripped filter."""
+    collection = command.get(name)
+    if name == "aggregate":
+        stages = [next(iter(stage), "") for stage in command.get("pipeline", [])]
+        first = command.get("pipeline", [{}])[0] if command.get("pipeline") else {}
+        query = {"stages": stages, "match": _strip_values(first.get("$match", {}))}
+    elif name in ("update", "delete"):
+        ops = command.get("updates") or command.get("deletes") or [{}]
+        query = _strip_values(ops[0].get("q", {}))
+    else:
+        query = _strip_values(command.get("filter") or command.get("query") or {})
+    return f"{collection}.{name} {json.dumps(query, sort_keys=True, default=str)}"
+
+
+def _request_scope():
+    """(route, slug) of the current request, if any."""
+    if not has_request_context():
+        return "(no request)", None
+    view_args = request.view_args or {}
+    return request.endpoint or request.path, view_args.get('path') or view_args.get('slug')
+
+
+class DBProfiler(monitoring.CommandListener):
+    """Records duration and documents returned for every profiled command."""
+
+    def __init__(self):
+        self.pending = {}
+        # Cursor id -> the command that opened it, so getMore batches add to its shape
+        self.cursors = OrderedDict()
+
+    def started(self, event):
+        if event.command_name == "killCursors":
+            with db_profile_lock:
+                for cursor_id in event.command.get("cursors", []):
+                    self.cursors.pop(cursor_id, None)
+            return
+        if event.command_name not in DB_PROFILED_COMMANDS:
+            return
+        if event.command_name == "getMore":
+            cursor_id = event.command.get("getMore")
+            opener = self.cursors.get(cursor_id)
+            if opener:
+                self.pending[event.request_id] = {**opener, "cursor_id": cursor_id}
+            return
+        route, slug = _request_scope()
+        self.pending[event.request_id] = {
+            "shape": _command_shape(event.command_name, event.command),
+            "route": route,
+            "slug": slug,
+            "phase": getattr(profiler_state, "phase", None)
+        }
+
+    def succeeded(self, event):
+        info = self.pending.pop(event.request_id, None)
+        if info:
+            reply = event.reply or {}
+            cursor = reply.get("cursor")
+            if cursor is not None:
+                docs = len(cursor.get("nextBatch" if "cursor_id" in info else "firstBatch", []))
+                self._track_cursor(info, cursor.get("id"))
+            else:
+                docs = reply.get("n", 0)
+            self._record(info, event.duration_micros / 1000, docs)
+
+    def failed(self, event):
+        info = self.pending.pop(event.request_id, None)
+        if info:
+            self._record(info, event.duration_micros / 1000, 0, failed=True)
+
+    def _track_cursor(self, info, cursor_id):
+        """Remembers cursors left open by a command; exhausted ones (id 0) are forgotten."""
+        with db_profile_lock:
+            if "cursor_id" in info:
+                if not cursor_id:
+                    self.cursors.pop(info["cursor_id"], None)
+                return
+            if cursor_id:
+                self.cursors[cursor_id] = info
+                while len(self.cursors) > DB_OPEN_CURSORS_MAX:
+                    self.cursors.popitem(last=False)
+
+    def _record(self, info, ms, docs, failed=False):
+        key = (info["route"], info["shape"])
+        get_more = "cursor_id" in info
+        with db_profile_lock:
+            stats = db_profile["shapes"].setdefault(key, {
+                "route": info["route"], "shape": info["shape"], "count": 0,
+                "total_ms": 0.0, "max_ms": 0.0, "docs": 0, "failed": 0
+            })
+            # Follow-up batches add time and documents to the query, not extra calls
+            stats["count"] += 0 if get_more else 1
+            stats["total_ms"] += ms
+            stats["max_ms"] = max(stats["max_ms"], ms)
+            stats["docs"] += docs
+            stats["failed"] += int(failed)
+            if ms >= DB_SLOW_QUERY_MS:
+                entry = {k: v for k, v in info.items() if k != "cursor_id"}
+                db_profile["slow"].append({**entry, "ms": round(ms, 2), "docs": docs, "at": datetime.now().isoformat()})
+
+        # Per-request tally, checked for N+1 patterns once the request ends
+        calls = getattr(profiler_state, "calls", None)
+        if calls is not None and not get_more:
+            calls[(info["shape"], info["phase"])] += 1
+
+
+@app.before_request
+def _start_db_profile():
+    profiler_state.calls = Counter()
+    profiler_state.phase = None
+
+
+@app.after_request
+def _finish_db_profile(response):
+    calls = getattr(profiler_state, "calls", None)
+    profiler_state.calls = None
+    if calls:
+        route, slug = _request_scope()
+        for (shape, phase), count in calls.items():
+            if count >= DB_N_PLUS_ONE_THRESHOLD:
+                with db_profile_lock:
+                    db_profile["n_plus_one"].append({
+                        "route": route, "slug": slug, "shape": shape, "count": count,
+                        "in_python_logic": phase == "logic", "at": datetime.now().isoformat()
+                    })
+    return response
+
+
+def db_profile_snapshot():
+    """Aggregated profiler data, slowest shapes first."""
+    with db_profile_lock:
+        shapes = sorted(db_profile["shapes"].values(), key=lambda s: s["total_ms"], reverse=True)
+        return {
+            "slow_threshold_ms": DB_SLOW_QUERY_MS,
+            "shapes": [{**s, "avg_ms": round(s["total_ms"] / s["count"], 2), "total_ms": round(s["total_ms"], 2),
+                        "max_ms": round(s["max_ms"], 2)} for s in shapes],
+            "slow": list(reversed(db_profile["slow"])),
+            "n_plus_one": list(reversed(db_profile["n_plus_one"]))
+        }
+
+
+class PageCommandCounter(monitoring.CommandListener):
+    """Charges every command issued while a page renders to that page's PageData."""
+
+    def started(self, event):
+        page_data = getattr(profiler_state, "page_data", None)
+        if page_data is not None:
+            page_data.db_calls += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
 # --- DATABASE CONNECTION ---
 MONGO_URI = os.environ.get("MONGODB_URI")
-client = MongoClient(MONGO_URI, tlsCAFile=certifi.where())
+client = MongoClient(MONGO_URI, tlsCAFile=certifi.where(),
+                     event_listeners=[PageCommandCounter()] + ([DBProfiler()] if DB_PROFILER_ENABLED else []))
 db = client.my_portfolio
 pages_collection = db.pages
 settings_collection = db.settings
 analytics_collection = db.analytics
-
-og_cache = {"image": None, "expiry": datetime.now()}
+revisions_collection = db.page_revisions
+search_collection = db.page_search
+profiles_collection = db.render_profiles
+
+og_cache = {"image": None, "expiry": datetime.now(), "loaded": False}
+og_cache_lock = threading.Lock()
+OG_CACHE_TTL = timedelta(hours=6)
+OG_RETRY_AFTER = timedelta(minutes=5)
+
+# Shared HTTP session so outbound calls reuse pooled keep-alive connections
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+
+# --- RESPONSE PIPELINE ---
+# HTML responses are minified (markup, inline <style> and inline <script>) and
+# compressed with brotli or gzip per Accept-Encoding. Results are cached by a
+# hash of the raw body, so identical renders skip minify and compress.
+# <pre>, <code> and <textarea> are left byte-for-byte. Elsewhere only text
+# between tags is collapsed, never attribute values, and runs holding a line
+# break keep one newline so white-space: pre-line/pre-wrap text keeps its lines.
+# CSS string literals are untouched; JS only loses blank lines and trailing
+# whitespace (plus indentation when it has no template literals).
+COMPRESS_MIN_BYTES = 512
+COMPRESS_CACHE_MAX_ENTRIES = 128
+PROTECTED_BLOCKS = re.compile(r"(<(pre|code|textarea|script|style)\b[^>]*>)(.*?)(</\2\s*>)", re.DOTALL | re.IGNORECASE)
+HTML_COMMENTS = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL)
+MARKUP_TAGS = re.compile(r"""<(?:[^>"']|"[^"]*"|'[^']*')*>""")
+TEXT_WHITESPACE = re.compile(r"\s{2,}|\n")
+CSS_TOKENS = re.compile(r"""/\*.*?\*/|"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'""", re.DOTALL)
+CSS_PUNCTUATION = re.compile(r"\s*([{};,>])\s*")
+
+compressed_cache = OrderedDict()
+compressed_cache_lock = threading.Lock()
+
+
+def _minify_css_code(css):
+    css = re.sub(r"\s+", " ", css)
+    css = CSS_PUNCTUATION.sub(r"\1", css)
+    # Spaces before ':' are selector combinators, only the ones after are safe to drop
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}")
+
+
+def minify_css(css):
+    """Drops comments and whitespace from CSS, leaving quoted strings as written."""
+    parts, code, last = [], "", 0
+    for m in CSS_TOKENS.finditer(css):
+        code += css[last:m.start()]
+        last = m.end()
+        if m.group(0).startswith("/*"):
+            continue
+        parts.extend([_minify_css_code(code), m.group(0)])
+        code = ""
+    parts.append(_minify_css_code(code + css[last:]))
+    return "".join(parts).strip()
+
+
+def minify_js(js):
+    lines = [line.rstrip() for line in js.splitlines()]
+    if "`" not in js:
+        lines = [line.lstrip() for line in lines]
+    return "\n".join(line for line in lines if line)
+
+
+def _collapse_text(run):
+    return "\n" if "\n" in run.group(0) else " "
+
+
+def _minify_markup(markup):
+    """Strips comments and collapses whitespace in text nodes, leaving tags as written."""
+    markup = HTML_COMMENTS.sub("", markup)
+    parts, last = [], 0
+    for m in MARKUP_TAGS.finditer(markup):
+        parts.append(TEXT_WHITESPACE.sub(_collapse_text, markup[last:m.start()]))
+        parts.append(m.group(0))
+        last = m.end()
+    parts.append(TEXT_WHITESPACE.sub(_collapse_text, markup[last:]))
+    return "".join(parts)
+
+
+def minify_html(markup):
+    """Collapses whitespace and comments outside protected blocks and minifies inline CSS/JS."""
+    parts, last = [], 0
+    for m in PROTECTED_BLOCKS.finditer(markup):
+        parts.append(_minify_markup(markup[last:m.start()]))
+        open_tag, tag, body, close_tag = m.group(1), m.group(2).lower(), m.group(3), m.group(4)
+        if tag == "style":
+            body = minify_css(body)
+        elif tag == "script":
+            body = minify_js(body)
+        parts.append(open_tag + body + close_tag)
+        last = m.end()
+    parts.append(_minify_markup(markup[last:]))
+    return "".join(parts).strip()
+
+
+def negotiate_encoding(accept_encoding):
+    """Picks br over gzip when the client accepts it, else None."""
+    accepted = {token.split(";")[0].strip().lower() for token in (accept_encoding or "").split(",")}
+    if "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def encode_html(raw, encoding):
+    """Minified (and compressed, if `encoding`) bytes for a raw HTML body, cached by content hash."""
+    key = (hashlib.sha256(raw).hexdigest(), encoding)
+    with compressed_cache_lock:
+        if key in compressed_cache:
+            compressed_cache.move_to_end(key)
+            return compressed_cache[key]
+
+    body = minify_html(raw.decode("utf-8")).encode("utf-8")
+    if encoding == "br":
+        body = brotli.compress(body, mode=brotli.MODE_TEXT, quality=5)
+    elif encoding == "gzip":
+        body = gzip.compress(body, compresslevel=6)
+
+    with compressed_cache_lock:
+        compressed_cache[key] = body
+        while len(compressed_cache) > COMPRESS_CACHE_MAX_ENTRIES:
+            compressed_cache.popitem(last=False)
+    return body
+
+
+@app.after_request
+def _minify_and_compress(response):
+    """Response stage applying minify_html and brotli/gzip to rendered HTML."""
+    if (response.direct_passthrough or response.is_streamed or response.mimetype != "text/html"
+            or "Content-Encoding" in response.headers):
+        return response
+    raw = response.get_data()
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return response
+
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    try:
+        response.set_data(encode_html(raw, encoding))
+    except Exception as e:
+        print(f"Response Pipeline Error: {e}")
+        return response
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
 
 
 # --- AUTH DECORATOR ---
@@ -44,24 +400,121 @@ def login_required(f):
     return decorated_function
 
 
+# --- CACHE COHERENCE ---
+# In-process caches are shared-nothing across Vercel/gunicorn instances. Admin
+# writes bump a per-namespace revision in the "cache_revisions" settings
+# document; every instance polls it at most once per REVISION_CHECK_INTERVAL
+# and runs the invalidators registered for any namespace that moved. Admin
+# edits are therefore visible everywhere within that interval.
+REVISION_CHECK_INTERVAL = 5  # seconds
+
+cache_revisions = {"seen": {}, "checked_at": datetime.min}
+cache_invalidators = {}
+revision_lock = threading.Lock()
+
+
+def on_revision(namespace):
+    """Registers a function that drops this instance's caches for `namespace`."""
+    def register(fn):
+        cache_invalidators.setdefault(namespace, []).append(fn)
+        return fn
+    return register
+
+
+def _run_invalidators(namespace):
+    for fn in cache_invalidators.get(namespace, []):
+        try:
+            fn()
+        except Exception as e:
+            print(f"Cache Invalidation Error ({namespace}): {e}")
+
+
+def bump_revision(*namespaces):
+    """Records a write to `namespaces` for every instance and invalidates locally."""
+    for namespace in namespaces:
+        _run_invalidators(namespace)
+    try:
+        doc = settings_collection.find_one_and_update(
+            {"name": "cache_revisions"},
+            {"$inc": {f"revisions.{ns}": 1 for ns in namespaces}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        with revision_lock:
+            cache_revisions["seen"].update({ns: doc["revisions"][ns] for ns in namespaces})
+    except Exception as e:
+        print(f"Revision Bump Error: {e}")
+
+
+@app.before_request
+def _sync_cache_revisions():
+    """Drops stale cache namespaces when another instance has bumped their revision."""
+    now = datetime.now()
+    with revision_lock:
+        if (now - cache_revisions["checked_at"]).total_seconds() < REVISION_CHECK_INTERVAL:
+            return
+        cache_revisions["checked_at"] = now
+
+    try:
+        doc = settings_collection.find_one({"name": "cache_revisions"}) or {}
+    except Exception as e:
+        print(f"Revision Check Error: {e}")
+        return
+
+    for namespace, revision in doc.get("revisions", {}).items():
+        with revision_lock:
+            stale = cache_revisions["seen"].get(namespace) != revision
+            cache_revisions["seen"][namespace] = revision
+        if stale:
+            _run_invalidators(namespace)
+
+
 # --- SETTINGS HELPERS ---
+SITE_CACHE_TTL = 300  # seconds, upper bound when revisions are not bumped
+site_cache = {}
+
+
+@on_revision("settings")
+def _drop_settings_cache():
+    site_cache.pop("settings", None)
+
+
+@on_revision("maintenance")
+def _drop_maintenance_cache():
+    site_cache.pop("maintenance", None)
+
+
+def _cached_site_value(name, loader):
+    """Returns a cached settings value, loading it on a miss. Loader errors propagate."""
+    entry = site_cache.get(name)
+    if entry and entry["expiry"] > datetime.now():
+        return copy.deepcopy(entry["value"])
+    value = loader()
+    site_cache[name] = {"value": value, "expiry": datetime.now() + timedelta(seconds=SITE_CACHE_TTL)}
+    return copy.deepcopy(value)
+
+
+def _load_site_settings():
+    settings = settings_collection.find_one({"name": "global_config"})
+    if not settings:
+        return {
+            "site_name_first": "Kurtis-Lee",
+            "site_name_last": "Hopewell",
+            "show_navbar": True,
+            "nav_links": []
+        }
+    # Ensure fallback for missing fields in existing documents
+    if 'site_name_first' not in settings:
+        settings['site_name_first'] = "Kurtis-Lee"
+    if 'site_name_last' not in settings:
+        settings['site_name_last'] = "Hopewell"
+    return settings
+
+
 def get_site_settings():
     """Fetches global configuration from MongoDB or returns defaults."""
     try:
-        settings = settings_collection.find_one({"name": "global_config"})
-        if not settings:
-            return {
-                "site_name_first": "Kurtis-Lee",
-                "site_name_last": "Hopewell",
-                "show_navbar": True,
-                "nav_links": []
-            }
-        # Ensure fallback for missing fields in existing documents
-        if 'site_name_first' not in settings:
-            settings['site_name_first'] = "Kurtis-Lee"
-        if 'site_name_last' not in settings:
-            settings['site_name_last'] = "Hopewell"
-        return settings
+        return _cached_site_value("settings", _load_site_settings)
     except:
         return {
             "site_name_first": "Kurtis-Lee",
@@ -71,19 +524,23 @@ def get_site_settings():
         }
 
 
+def _load_maintenance_mode():
+    config = settings_collection.find_one({"name": "maintenance_mode"})
+    if not config:
+        return False
+    
+    active = config.get("active")
+    # Ensure we only return True if it is explicitly the boolean True 
+    # or the lowercase string "true"
+    if isinstance(active, str):
+        return active.lower() == "true"
+    return bool(active) is True
+
+
 def is_maintenance_mode():
     """Strict boolean check for global maintenance."""
     try:
-        config = settings_collection.find_one({"name": "maintenance_mode"})
-        if not config:
-            return False
-        
-        active = config.get("active")
-        # Ensure we only return True if it is explicitly the boolean True 
-        # or the lowercase string "true"
-        if isinstance(active, str):
-            return active.lower() == "true"
-        return bool(active) is True
+        return _cached_site_value("maintenance", _load_maintenance_mode)
     except:
         return False
 
@@ -99,31 +556,179 @@ def generate_visitor_hash():
     # Hash the fingerprint so we don't store plain-text PII (Personally Identifiable Information)
     return hashlib.sha256(fingerprint.encode()).hexdigest()
 
-def log_visit(path, status_code=200):
+# --- TRAFFIC CLASSIFIER ---
+# Bot signatures and referrer rules are compiled into one regex each, matched
+# against the lowercased input. The matched literal tells us which rule fired.
+# Rules live in the "traffic_rules" settings document so crawlers can be added
+# from the admin API without a deploy.
+DEFAULT_BOT_SIGNATURES = [
+    'bot', 'crawler', 'spider', 'slurp', 'lighthouse', # General
+    'googlebot', 'google-keyword-suggestion',         # Google
+    'discordbot',                                     # Discord
+    'linkedinbot',                                    # LinkedIn
+    'bingbot', 'bingpreview', 'msnbot',               # Microsoft/Bing
+    'vercel', 'vercel-screenshot', 'vercel-bot'       # Vercel
+]
+DEFAULT_REFERRER_RULES = [
+    {"match": "google", "label": "Google Search"},
+    {"match": "linkedin", "label": "LinkedIn"},
+    {"match": "github", "label": "GitHub"}
+]
+TRAFFIC_RULES_REFRESH = 60  # seconds between settings lookups
+
+traffic_classifier = {"bots": None, "bot_rules": [], "referrers": None, "referrer_rules": [], "expiry": datetime.now()}
+traffic_rule_hits = Counter()
+
+
+def compile_rule_set(patterns, ordered=False):
+    """Compiles literal patterns into one regex over lowercased input.
+
+    Returns (regex, {literal: rule index}, ordered). Unordered sets are a plain alternation
+    for a single `.search`. Ordered sets wrap the alternation in a lookahead so
+    `match_rule` sees every rule that fires and can honour list order.
+    """
+    literals = {}
+    for i, p in enumerate(patterns):
+        literals.setdefault(p.lower(), i)
+    if not literals:
+        return None
+    pattern = "|".join(re.escape(p) for p in literals)
+    if ordered:
+        pattern = f"(?=({pattern}))"
+    return re.compile(pattern), literals, ordered
+
+
+def get_traffic_classifier(force=False):
+    """Returns the compiled classifier, reloading rules from settings when stale."""
+    now = datetime.now()
+    # Staleness is decided by expiry alone; an empty rule list compiles to None
+    if not force and traffic_classifier["expiry"] > now:
+        return traffic_classifier
+
+    bot_rules, referrer_rules = DEFAULT_BOT_SIGNATURES, DEFAULT_REFERRER_RULES
+    try:
+        config = settings_collection.find_one({"name": "traffic_rules"})
+        if config:
+            bot_rules = [str(x).lower() for x in config.get("bot_signatures", bot_rules) if x]
+            referrer_rules = [r for r in config.get("referrer_rules", referrer_rules)
+                              if isinstance(r, dict) and r.get("match") and r.get("label")]
+    except Exception as e:
+        print(f"Traffic Rules Error: {e}")
+
+    traffic_classifier.update({
+        "bots": compile_rule_set(bot_rules),
+        "bot_rules": bot_rules,
+        "referrers": compile_rule_set([r["match"] for r in referrer_rules], ordered=True),
+        "referrer_rules": referrer_rules,
+        "expiry": now + timedelta(seconds=TRAFFIC_RULES_REFRESH)
+    })
+    return traffic_classifier
+
+
+@on_revision("traffic")
+def _expire_traffic_classifier():
+    traffic_classifier["expiry"] = datetime.now()
+
+
+@lru_cache(maxsize=4096)
+def library_flags_bot(ua_string):
+    """Falls back to the user_agents parser for bots our signatures miss."""
+    return parse(ua_string).is_bot
+
+
+def match_rule(rule_set, value):
+    """Returns the index of a rule matching `value`, or None.
+
+    Unordered sets return whichever rule matched first in the string. Ordered
+    sets return the lowest matching rule index, so list order is priority.
+    """
+    if rule_set is None or not value:
+        return None
+    pattern, literals, ordered = rule_set
+    value = value.lower()
+    if not ordered:
+        m = pattern.search(value)
+        return literals[m.group(0)] if m else None
+    indexes = [literals[m.group(1)] for m in pattern.finditer(value)]
+    return min(indexes) if indexes else None
+
+
+def classify_bot(ua_string, count=True):
+    """True if the User-Agent matches a bot signature or the parser's bot list."""
+    classifier = get_traffic_classifier()
+    index = match_rule(classifier["bots"], ua_string)
+    if index is not None:
+        if count:
+            traffic_rule_hits[f"bot:{classifier['bot_rules'][index]}"] += 1
+        return True
+    return library_flags_bot(ua_string)
+
+
+def classify_referrer(raw_referrer, count=True):
+    """Maps a raw referrer to its rule label, or the bare host when no rule matches."""
+    classifier = get_traffic_classifier()
+    index = match_rule(classifier["referrers"], raw_referrer)
+    if index is not None:
+        rule = classifier["referrer_rules"][index]
+        if count:
+            traffic_rule_hits[f"referrer:{rule['label']}"] += 1
+        return rule["label"]
+    if not raw_referrer:
+        return "Direct Entry"
+    return raw_referrer.split('//')[-1].split('/')[0]
+
+
+# --- ANALYTICS SAMPLING ---
+# Successful hits are recorded for a fraction p of visitors. p is
+# ANALYTICS_SAMPLE_RATE, lowered further when this instance sees more than
+# ANALYTICS_TARGET_RATE hits per second. The choice is made per visitor hash,
+# so each kept visitor's hits are all recorded. Every document stores
+# weight = 1/p, and the dashboard sums weights instead of counting
+# documents, keeping totals and unique visitors unbiased. Errors are never
+# sampled.
+ANALYTICS_SAMPLE_RATE = float(os.environ.get("ANALYTICS_SAMPLE_RATE", "1.0"))
+ANALYTICS_TARGET_RATE = float(os.environ.get("ANALYTICS_TARGET_RATE", "20"))  # hits/sec, 0 disables adaptation
+WEIGHT = {"$ifNull": ["$weight", 1]}
+
+traffic_meter = {"second": 0, "count": 0, "rate": 0.0}
+traffic_meter_lock = threading.Lock()
+
+
+def current_sample_rate():
+    """Counts this hit and returns the sampling probability for it."""
+    now = int(time.time())
+    with traffic_meter_lock:
+        if now != traffic_meter["second"]:
+            # Exponentially smoothed hits/sec over completed seconds, idle seconds count as 0
+            idle = max(0, now - traffic_meter["second"] - 1)
+            traffic_meter["rate"] = (0.5 * traffic_meter["rate"] + 0.5 * traffic_meter["count"]) * (0.5 ** min(idle, 30))
+            traffic_meter["second"], traffic_meter["count"] = now, 0
+        traffic_meter["count"] += 1
+        rate = max(traffic_meter["rate"], traffic_meter["count"])
+
+    p = ANALYTICS_SAMPLE_RATE
+    if ANALYTICS_TARGET_RATE > 0 and rate > ANALYTICS_TARGET_RATE:
+        p = min(p, ANALYTICS_TARGET_RATE / rate)
+    return max(min(p, 1.0), 0.001)
+
+
+def log_visit(path, status_code=200, weight=1.0):
     # Ignore internal system paths
     if any(path.startswith(x) for x in ['admin', 'static', '_preview']) or path == 'favicon.ico':
         return
 
-    # --- ENHANCED BOT DETECTION ---
-    ua_string = request.headers.get('User-Agent', '')
-    user_agent = parse(ua_string)
-
-    # list of specific bot identifiers for Google, Discord, LinkedIn, Bing, and Vercel
-    bot_keywords = [
-        'bot', 'crawler', 'spider', 'slurp', 'lighthouse', # General
-        'googlebot', 'google-keyword-suggestion',         # Google
-        'discordbot',                                     # Discord
-        'linkedinbot',                                    # LinkedIn
-        'bingbot', 'bingpreview', 'msnbot',               # Microsoft/Bing
-        'vercel', 'vercel-screenshot', 'vercel-bot'       # Vercel
-    ]
-
-    # 1. Check if the library identifies it as a bot
-    # 2. Check for the specific keywords defined above
-    is_bot = user_agent.is_bot or any(x in ua_string.lower() for x in bot_keywords)
-
-    # --- PRIVACY & HASHING ---
+    # --- SAMPLING ---
     visitor_id = generate_visitor_hash()
+    if status_code == 200:
+        p = current_sample_rate()
+        if p < 1.0:
+            if int(visitor_id[:8], 16) / 0xFFFFFFFF >= p:
+                return
+            weight = weight / p
+
+    # --- BOT DETECTION ---
+    ua_string = request.headers.get('User-Agent', '')
+    is_bot = classify_bot(ua_string)
 
     # --- REFERRER LOGIC ---
     custom_ref = request.args.get('redirectfrom')
@@ -132,14 +737,10 @@ def log_visit(path, status_code=200):
 
     if current_host in raw_referrer and not custom_ref:
         final_source = "Direct / Internal"
+    elif custom_ref:
+        final_source = f"Campaign: {custom_ref}"
     else:
-        ref_low = raw_referrer.lower()
-        if custom_ref: final_source = f"Campaign: {custom_ref}"
-        elif "google" in ref_low: final_source = "Google Search"
-        elif "linkedin" in ref_low: final_source = "LinkedIn"
-        elif "github" in ref_low: final_source = "GitHub"
-        elif not raw_referrer: final_source = "Direct Entry"
-        else: final_source = raw_referrer.split('//')[-1].split('/')[0]
+        final_source = classify_referrer(raw_referrer)
 
     # --- COMMIT TO DB ---
     analytics_collection.insert_one({
@@ -149,16 +750,656 @@ def log_visit(path, status_code=200):
         "visitor_hash": visitor_id,
         "referrer": final_source,
         "agent": ua_string,
-        "is_bot": is_bot 
+        "is_bot": is_bot,
+        "weight": round(weight, 4)
     })
 
 
+# --- ANALYTICS AGGREGATION ---
+# The dashboard is served from a single $facet aggregation. Hits are grouped
+# server-side by (bucket, agent, referrer), which is the dictionary-encoded
+# column set the stats pass consumes: each distinct agent is parsed once, so
+# browser/os/device filters resolve per agent code, not per row.
+ANALYTICS_CACHE_TTL = 30  # seconds
+ANALYTICS_CACHE_MAX_ENTRIES = 64
+analytics_cache = {}
+
+
+@lru_cache(maxsize=4096)
+def classify_agent(agent):
+    """Parses a User-Agent string into (browser, os, device). Cached per process."""
+    ua = parse(agent or '')
+    device = "Mobile" if ua.is_mobile else "Tablet" if ua.is_tablet else "Desktop"
+    return ua.browser.family, ua.os.family, device
+
+
+def fetch_dashboard_facets(match, date_format):
+    """Streams chart rows from their own aggregate and runs one $facet for top pages and visitors."""
+    # Rows stay out of $facet: its single result document is capped at 16MB, which
+    # bucket x agent x referrer groups can exceed on long ranges
+    rows_pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {
+                "bucket": {"$dateToString": {"format": date_format, "date": "$timestamp"}},
+                "agent": {"$ifNull": ["$agent", ""]},
+                "referrer": {"$ifNull": ["$referrer", "Direct Entry"]}
+            },
+            "url": {"$first": "$full_referrer_url"},
+            "count": {"$sum": WEIGHT}
+        }}
+    ]
+    rows = list(analytics_collection.aggregate(rows_pipeline, allowDiskUse=True, batchSize=5000))
+
+    pipeline = [
+        {"$match": match},
+        {"$facet": {
+            "top_pages": [
+                {"$group": {"_id": "$path", "count": {"$sum": WEIGHT}}},
+                {"$sort": {"count": -1}}, {"$limit": 8},
+                {"$set": {"count": {"$round": ["$count", 0]}}}
+            ],
+            "visitors": [
+                {"$group": {"_id": "$visitor_hash", "weight": {"$max": WEIGHT}}},
+                {"$group": {"_id": None, "total": {"$sum": "$weight"}}}
+            ]
+        }}
+    ]
+    result = next(analytics_collection.aggregate(pipeline, allowDiskUse=True), {})
+    visitors = result.get("visitors") or [{"total": 0}]
+    return {
+        "rows": rows,
+        "top_pages": result.get("top_pages", []),
+        "unique_visitors": round(visitors[0]["total"])
+    }
+
+
+def get_dashboard_facets(cache_key, match, date_format):
+    """Returns cached facet results for a filter combination, refreshing after the TTL."""
+    now = datetime.now()
+    entry = analytics_cache.get(cache_key)
+    if entry and entry["expiry"] > now:
+        return entry["value"]
+
+    value = fetch_dashboard_facets(match, date_format)
+
+    # Drop expired entries and keep the cache bounded
+    for key in [k for k, v in analytics_cache.items() if v["expiry"] <= now]:
+        del analytics_cache[key]
+    while len(analytics_cache) >= ANALYTICS_CACHE_MAX_ENTRIES:
+        analytics_cache.pop(next(iter(analytics_cache)))
+
+    analytics_cache[cache_key] = {"value": value, "expiry": now + timedelta(seconds=ANALYTICS_CACHE_TTL)}
+    return value
+
+
+def encode_analytics_columns(rows):
+    """Turns grouped facet rows into columns with the agent dictionary-encoded."""
+    agents, agent_codes = [], {}
+    columns = {"bucket": [], "agent": [], "referrer": [], "referrer_url": [], "count": []}
+    for row in rows:
+        agent = row["_id"].get("agent") or ''
+        code = agent_codes.get(agent)
+        if code is None:
+            code = agent_codes[agent] = len(agents)
+            agents.append(agent)
+
+        columns["bucket"].append(row["_id"].get("bucket"))
+        columns["agent"].append(code)
+        columns["referrer"].append(row["_id"].get("referrer", 'Direct Entry'))
+        columns["referrer_url"].append(row.get("url") or '')
+        columns["count"].append(row["count"])
+
+    return columns, agents
+
+
+def aggregate_analytics_columns(columns, agents, active_filters):
+    """Computes chart buckets and sidebar stats for every filter in one pass."""
+    # Resolve browser/os/device filters against the agent dictionary, not the rows
+    classified = [classify_agent(agent) for agent in agents]
+    allowed = [
+        ('browser' not in active_filters or active_filters['browser'] == browser) and
+        ('os' not in active_filters or active_filters['os'] == os_family) and
+        ('device' not in active_filters or active_filters['device'] == device)
+        for browser, os_family, device in classified
+    ]
+
+    chart, agent_hits, referrers = Counter(), Counter(), Counter()
+    referrer_urls = {}
+    for bucket, code, ref_name, ref_url, count in zip(columns["bucket"], columns["agent"], columns["referrer"],
+                                                      columns["referrer_url"], columns["count"]):
+        if not allowed[code]:
+            continue
+        chart[bucket] += count
+        agent_hits[code] += count
+        referrers[ref_name] += count
+        referrer_urls.setdefault(ref_name, ref_url)
+
+    # Fold per-agent totals into the browser/os/device facets
+    browsers, os_counts, devices = Counter(), Counter(), Counter()
+    for code, count in agent_hits.items():
+        browser, os_family, device = classified[code]
+        browsers[browser] += count
+        os_counts[os_family] += count
+        devices[device] += count
+
+    # Weighted sums are estimates; report whole hits
+    def whole(counter):
+        return {k: round(v) for k, v in counter.items()}
+
+    stats = {
+        "browsers": whole(browsers),
+        "os": whole(os_counts),
+        "devices": whole(devices),
+        "referrers": whole(referrers),
+        "referrers_detailed": {
+            name: {"count": round(count), "url": referrer_urls.get(name, '')} for name, count in referrers.items()
+        }
+    }
+    return whole(chart), stats, round(sum(agent_hits.values()))
+
+
+# --- 404 FLOOD PROTECTION ---
+# Slugs that missed in pages_collection are remembered for a while so scanner
+# traffic (/wp-login.php, /.env, ...) skips the database. 404 hits are counted
+# in memory per path per minute and flushed as one upserted document each,
+# from a teardown hook once the interval passes or the minute rolls over.
+# NOT_FOUND_LOG_MODE: "aggregate" (default), "sample" (NOT_FOUND_SAMPLE_RATE
+# of hits logged individually) or "full" (one document per hit).
+MISSING_SLUG_TTL = 300  # seconds
+MISSING_SLUG_MAX_ENTRIES = 2048
+NOT_FOUND_LOG_MODE = os.environ.get("NOT_FOUND_LOG_MODE", "aggregate")
+NOT_FOUND_SAMPLE_RATE = float(os.environ.get("NOT_FOUND_SAMPLE_RATE", "0.05"))
+NOT_FOUND_FLUSH_INTERVAL = 10  # seconds
+
+missing_slugs = {}
+not_found_buffer = {"counts": Counter(), "flushed_at": datetime.now()}
+not_found_lock = threading.Lock()
+
+
+def is_known_missing(slug):
+    """True if `slug` recently missed in pages_collection."""
+    expiry = missing_slugs.get(slug)
+    if expiry is None:
+        return False
+    if expiry <= datetime.now():
+        missing_slugs.pop(slug, None)
+        return False
+    return True
+
+
+def remember_missing_slug(slug):
+    """Caches a slug miss, evicting the oldest entries past the size bound."""
+    missing_slugs.pop(slug, None)
+    while len(missing_slugs) >= MISSING_SLUG_MAX_ENTRIES:
+        missing_slugs.pop(next(iter(missing_slugs)), None)
+    missing_slugs[slug] = datetime.now() + timedelta(seconds=MISSING_SLUG_TTL)
+
+
+def flush_not_found_counts(force=False):
+    """Writes buffered 404 counts as one $inc upsert per path and minute."""
+    with not_found_lock:
+        now = datetime.now()
+        age = (now - not_found_buffer["flushed_at"]).total_seconds()
+        # A buffered minute that has already ended is flushed right away
+        rolled_over = not_found_buffer["flushed_at"].minute != now.minute
+        if not not_found_buffer["counts"] or (not force and not rolled_over and age < NOT_FOUND_FLUSH_INTERVAL):
+            return
+        counts = not_found_buffer["counts"]
+        not_found_buffer["counts"], not_found_buffer["flushed_at"] = Counter(), now
+
+    operations = [
+        UpdateOne(
+            {"path": path, "status_code": 404, "timestamp": minute, "aggregated": True},
+            {"$inc": {"hits": hits}},
+            upsert=True
+        )
+        for (path, minute), hits in counts.items()
+    ]
+    try:
+        analytics_collection.bulk_write(operations, ordered=False)
+    except Exception as e:
+        print(f"404 Log Flush Error: {e}")
+
+
+def log_not_found(path):
+    """Records a 404 according to NOT_FOUND_LOG_MODE."""
+    if NOT_FOUND_LOG_MODE == "full":
+        return log_visit(path, 404)
+    if NOT_FOUND_LOG_MODE == "sample":
+        if random.random() < NOT_FOUND_SAMPLE_RATE:
+            log_visit(path, 404, weight=1 / NOT_FOUND_SAMPLE_RATE)
+        return
+
+    if any(path.startswith(x) for x in ['admin', 'static', '_preview']) or path == 'favicon.ico':
+        return
+    minute = datetime.now().replace(second=0, microsecond=0)
+    with not_found_lock:
+        not_found_buffer["counts"][(path, minute)] += 1
+
+
+@app.teardown_request
+def _flush_not_found_on_teardown(exc=None):
+    """Flushes due 404 counts after every request, so an idle or frozen instance loses little."""
+    flush_not_found_counts()
+
+
+# --- PAGE DATA HELPER ---
+# Injected into page python_logic and templates as `data`. Reads are memoized
+# across requests with a per-call TTL, so logic-heavy pages stop hitting Mongo
+# on every view. Every entry is tagged with its collection name, which lets the
+# admin write paths invalidate e.g. tag "pages" when content changes.
+PAGE_DATA_CACHE_MAX_ENTRIES = 512
+PAGE_QUERY_BUDGET = int(os.environ.get("PAGE_QUERY_BUDGET", "25"))
+
+page_data_cache = {}
+page_data_lock = threading.Lock()
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """Raised when a page issues more DB calls than its query budget allows."""
+
+
+def invalidate_page_data(key=None, tag=None):
+    """Drops cached page data by exact key, by tag, or everything when neither is given."""
+    with page_data_lock:
+        if key is None and tag is None:
+            page_data_cache.clear()
+            return
+        for k in [k for k, v in page_data_cache.items() if k == key or (tag is not None and tag in v["tags"])]:
+            del page_data_cache[k]
+
+
+class PageData:
+    """Memoized, budgeted Mongo reads for a single page request.
+
+    `db_calls` counts every command issued while the page renders (through
+    PageCommandCounter), including raw `db` use in python_logic and templates.
+    """
+
+    def __init__(self, slug, budget=PAGE_QUERY_BUDGET):
+        self.slug = slug
+        self.budget = budget
+        self.db_calls = 0
+        self.cache_hits = 0
+
+    def charge(self):
+        """Raises QueryBudgetExceeded once the page has used up its DB calls."""
+        if self.db_calls >= self.budget:
+            raise QueryBudgetExceeded(f"Page '{self.slug}' exceeded its budget of {self.budget} DB calls")
+
+    def _cached(self, operation, collection, args, fetch, ttl, key, tags):
+        key = key or hashlib.sha256(json.dumps([operation, collection, args], default=str, sort_keys=True).encode()).hexdigest()
+        now = datetime.now()
+        entry = page_data_cache.get(key)
+        if entry and entry["expiry"] > now:
+            self.cache_hits += 1
+            return copy.deepcopy(entry["value"])
+
+        self.charge()
+        value = fetch()
+
+        if ttl > 0:
+            with page_data_lock:
+                page_data_cache.pop(key, None)
+                while len(page_data_cache) >= PAGE_DATA_CACHE_MAX_ENTRIES:
+                    page_data_cache.pop(next(iter(page_data_cache)))
+                page_data_cache[key] = {
+                    "value": value,
+                    "expiry": now + timedelta(seconds=ttl),
+                    "tags": {collection, *tags}
+                }
+        return copy.deepcopy(value)
+
+    def find(self, collection, filter=None, projection=None, sort=None, limit=0, ttl=60, key=None, tags=()):
+        """Cached `find` returning a list of documents."""
+        def fetch():
+            cursor = db[collection].find(filter or {}, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            return list(cursor.limit(limit))
+        return self._cached("find", collection, [filter, projection, sort, limit], fetch, ttl, key, tags)
+
+    def find_one(self, collection, filter=None, projection=None, ttl=60, key=None, tags=()):
+        """Cached `find_one`."""
+        return self._cached("find_one", collection, [filter, projection],
+                            lambda: db[collection].find_one(filter or {}, projection), ttl, key, tags)
+
+    def aggregate(self, collection, pipeline, ttl=60, key=None, tags=()):
+        """Cached `aggregate` returning a list of result documents."""
+        return self._cached("aggregate", collection, pipeline,
+                            lambda: list(db[collection].aggregate(pipeline)), ttl, key, tags)
+
+    def count(self, collection, filter=None, ttl=60, key=None, tags=()):
+        """Cached `count_documents`."""
+        return self._cached("count", collection, [filter],
+                            lambda: db[collection].count_documents(filter or {}), ttl, key, tags)
+
+    def invalidate(self, key=None, tag=None):
+        """Drops cached results by key or tag."""
+        invalidate_page_data(key=key, tag=tag)
+
+
+class BudgetedHandle:
+    """Wraps the `db` handle (or a collection) given to pages so every call checks the budget."""
+
+    def __init__(self, target, page_data):
+        self._target = target
+        self._page_data = page_data
+
+    def __getitem__(self, name):
+        return BudgetedHandle(self._target[name], self._page_data)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if isinstance(attr, Collection):
+            return BudgetedHandle(attr, self._page_data)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def call(*args, **kwargs):
+            self._page_data.charge()
+            return attr(*args, **kwargs)
+        return call
+
+
+# --- FRAGMENT CACHE ---
+# {% cache "projects", 300 %}...{% endcache %} in stored page content or page.html
+# caches the rendered block per page slug. Fragments are shared by every
+# visitor, so only wrap output that does not depend on the session. Editing or
+# deleting a page drops its fragments. Any object with get/set/delete_prefix
+# can replace the backend via app.jinja_env.fragment_cache.
+FRAGMENT_CACHE_MAX_ENTRIES = 256
+FRAGMENT_CACHE_DEFAULT_TTL = 300  # seconds
+
+
+class LRUFragmentCache:
+    """In-process LRU of rendered fragments with per-entry expiry."""
+
+    def __init__(self, max_entries=FRAGMENT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= datetime.now():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, datetime.now() + timedelta(seconds=ttl))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+
+class FragmentCacheExtension(Extension):
+    """Adds the {% cache key[, ttl] %}...{% endcache %} tag."""
+    tags = {"cache"}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=LRUFragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if("comma"):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        args.append(nodes.ContextReference())
+
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        return nodes.CallBlock(self.call_method("_cache_support", args), [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, key, ttl, context, caller):
+        # Only CMS pages are cached; previews and trial pages have no stable slug
+        page = context.get('page')
+        slug = page.get('slug') if isinstance(page, dict) else None
+        if not slug:
+            return caller()
+
+        cache_key = f"{slug}:{key}"
+        rendered = self.environment.fragment_cache.get(cache_key)
+        if rendered is None:
+            rendered = caller()
+            self.environment.fragment_cache.set(cache_key, rendered, ttl or FRAGMENT_CACHE_DEFAULT_TTL)
+        return rendered
+
+
+app.jinja_env.add_extension(FragmentCacheExtension)
+
+
+@on_revision("pages")
+def _drop_page_caches():
+    """Page content changed: forget slug misses, page-data reads and fragments."""
+    missing_slugs.clear()
+    invalidate_page_data(tag="pages")
+    app.jinja_env.fragment_cache.delete_prefix("")
+
+
+# --- ASSET PIPELINE ---
+# `flask --app api/index.py build-assets` compiles Tailwind ahead of time
+# instead of shipping the CDN JIT to every visitor. It scans the templates and
+# all stored page content, bundles the purged utilities with self-hosted
+# Google Fonts and Font Awesome, and writes content-hashed files to
+# static/dist, which are served with immutable caching. Run it at deploy time;
+# every instance then links the same committed bundle. The manifest records the
+# class tokens (class="..." values, classList calls) the build saw, and a page
+# using a class outside that set renders with the CDN fallback until the next
+# build. ASSET_AUTO_REBUILD=on rebuilds in the background when such a page is
+# saved. The new bundle only exists on that instance's disk, so enable it on
+# single-instance hosts only.
+TAILWIND_CONFIG = {
+    "darkMode": "class",
+    "theme": {
+        "extend": {
+            "fontFamily": {
+                "sans": ["Inter", "sans-serif"],
+                "mono": ['"Google Sans"', "sans-serif"]
+            },
+            "colors": {
+                "zinc": {"950": "#09090b", "900": "#18181b", "800": "#27272a", "700": "#3f3f46", "100": "#f4f4f5"},
+                "brand": "#6366f1"
+            },
+            "transitionTimingFunction": {
+                "expo": "cubic-bezier(0.16, 1, 0.3, 1)"
+            }
+        }
+    }
+}
+GOOGLE_FONTS_URL = "https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700;800&family=Google+Sans:opsz,wght@17..18,400..700&display=swap"
+FONT_AWESOME_URL = "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/7.0.1/css/all.min.css"
+TAILWIND_CLI = ["npx", "--yes", "tailwindcss@3.4.17"]
+ASSET_DIST_DIR = "dist"
+ASSET_MANIFEST = "manifest.json"
+ASSET_AUTO_REBUILD = os.environ.get("ASSET_AUTO_REBUILD", "off") == "on"
+CLASS_ATTRIBUTES = re.compile(
+    r"""\bclass(?:Name)?\s*=\s*(?:"([^"]*)"|'([^']*)')|classList\.(?:add|remove|toggle|replace)\(([^)]*)\)""")
+JINJA_EXPRESSIONS = re.compile(r"\{[{%].*?[%}]\}", re.DOTALL)
+QUOTED_LITERALS = re.compile(r"'([^']*)'|\"([^\"]*)\"")
+CSS_URLS = re.compile(r"url\((['\"]?)([^)'\"]+)\1\)")
+
+asset_state = {"manifest": None, "loaded": False, "building": threading.Lock()}
+
+
+def _dist_path(*parts):
+    return os.path.join(app.static_folder, ASSET_DIST_DIR, *parts)
+
+
+def get_asset_manifest():
+    """Loads static/dist/manifest.json once per process. None when no bundle is on disk."""
+    if not asset_state["loaded"]:
+        try:
+            with open(_dist_path(ASSET_MANIFEST), "r") as f:
+                manifest = json.load(f)
+            manifest["tokens"] = set(manifest.get("tokens", []))
+            # Never link a bundle this instance cannot serve
+            asset_state["manifest"] = manifest if os.path.exists(os.path.join(app.static_folder, manifest["css"])) else None
+        except (OSError, ValueError, KeyError):
+            asset_state["manifest"] = None
+        asset_state["loaded"] = True
+    return asset_state["manifest"]
+
+
+def class_tokens(*sources):
+    """Class names used in `sources`: class/className attribute values and classList calls."""
+    tokens = set()
+    for source in sources:
+        for m in CLASS_ATTRIBUTES.finditer(source or ""):
+            value = next(group for group in m.groups() if group is not None)
+            # Only the string literals of a {{ ... }} expression can be class names
+            value = JINJA_EXPRESSIONS.sub(lambda e: " ".join(a or b for a, b in QUOTED_LITERALS.findall(e.group(0))), value)
+            tokens.update(token.strip("'\"(),") for token in value.replace(",", " ").split())
+    tokens.discard("")
+    return tokens
+
+
+def bundle_covers(*sources):
+    """True when the built bundle already contains every utility `sources` may use."""
+    manifest = get_asset_manifest()
+    return bool(manifest) and class_tokens(*sources) <= manifest["tokens"]
+
+
+def _store_hashed(data, extension):
+    """Writes bytes to static/dist under their content hash and returns the static path."""
+    name = f"{hashlib.sha256(data).hexdigest()[:16]}.{extension}"
+    path = _dist_path(name)
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(data)
+    return f"{ASSET_DIST_DIR}/{name}"
+
+
+def _vendor_stylesheet(url, user_agent=None):
+    """Downloads a third-party stylesheet and its url() assets, rewriting them to local hashed files."""
+    headers = {"User-Agent": user_agent} if user_agent else {}
+    response = http_session.get(url, timeout=(3.05, 30), headers=headers)
+    response.raise_for_status()
+
+    def localise(match):
+        target = requests.compat.urljoin(url, match.group(2))
+        if target.startswith("data:"):
+            return match.group(0)
+        asset = http_session.get(target, timeout=(3.05, 30))
+        asset.raise_for_status()
+        extension = target.split("?")[0].rsplit(".", 1)[-1]
+        return f"url(/static/{_store_hashed(asset.content, extension)})"
+
+    return CSS_URLS.sub(localise, response.text)
+
+
+def build_assets():
+    """Compiles the purged Tailwind bundle plus vendored fonts/icons. Returns the manifest."""
+    os.makedirs(_dist_path(), exist_ok=True)
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    with open(os.path.join(template_dir, "partials", "site.tailwind.css"), "r") as f:
+        layers = f.read()
+
+    with tempfile.TemporaryDirectory() as work:
+        # Stored page content is scanned alongside the templates
+        sources = []
+        for page in pages_collection.find({}, {"slug": 1, "content": 1, "js": 1}):
+            sources.extend([page.get("content") or "", page.get("js") or ""])
+        with open(os.path.join(work, "pages.html"), "w", encoding="utf-8") as f:
+            f.write("\n".join(sources))
+        with open(os.path.join(work, "tailwind.config.js"), "w") as f:
+            content = [os.path.join(template_dir, "**", "*.html"), os.path.join(work, "pages.html")]
+            f.write(f"module.exports = {json.dumps({**TAILWIND_CONFIG, 'content': content}, indent=2)};\n")
+        with open(os.path.join(work, "input.css"), "w") as f:
+            f.write("@tailwind base;\n@tailwind components;\n@tailwind utilities;\n" + layers)
+
+        output = os.path.join(work, "tailwind.css")
+        subprocess.run(TAILWIND_CLI + ["-c", os.path.join(work, "tailwind.config.js"), "-i", os.path.join(work, "input.css"),
+                                       "-o", output, "--minify"], check=True, capture_output=True, cwd=work)
+        with open(output, "r", encoding="utf-8") as f:
+            tailwind_css = f.read()
+
+    template_sources = []
+    for root, _, files in os.walk(template_dir):
+        for name in files:
+            if name.endswith(".html"):
+                with open(os.path.join(root, name), "r", encoding="utf-8") as f:
+                    template_sources.append(f.read())
+
+    # A modern UA makes Google Fonts serve woff2
+    modern_ua = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+    bundle = "\n".join([
+        _vendor_stylesheet(GOOGLE_FONTS_URL, user_agent=modern_ua),
+        _vendor_stylesheet(FONT_AWESOME_URL),
+        tailwind_css
+    ])
+
+    manifest = {
+        "css": _store_hashed(bundle.encode("utf-8"), "css"),
+        "built_at": datetime.now().isoformat(),
+        "tokens": sorted(class_tokens(*template_sources, *sources))
+    }
+    with open(_dist_path(ASSET_MANIFEST), "w") as f:
+        json.dump(manifest, f)
+    asset_state["loaded"] = False
+    return get_asset_manifest()
+
+
+def schedule_asset_rebuild(*sources):
+    """Rebuilds the bundle in the background when saved content uses unseen tokens."""
+    if not ASSET_AUTO_REBUILD or bundle_covers(*sources) or not shutil.which("npx"):
+        return
+    if not os.access(app.static_folder, os.W_OK) or not asset_state["building"].acquire(blocking=False):
+        return
+
+    def rebuild():
+        try:
+            build_assets()
+        except Exception as e:
+            print(f"Asset Build Error: {e}")
+        finally:
+            asset_state["building"].release()
+
+    threading.Thread(target=rebuild, daemon=True).start()
+
+
+@app.after_request
+def _cache_hashed_assets(response):
+    """Content-hashed bundle files never change, so let browsers keep them."""
+    if request.path.startswith(f"/static/{ASSET_DIST_DIR}/") and response.status_code == 200 \
+            and not request.path.endswith(ASSET_MANIFEST):
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """Compile the purged Tailwind bundle with self-hosted fonts and icons."""
+    manifest = build_assets()
+    click.echo(f"Built {manifest['css']} ({len(manifest['tokens'])} tokens scanned)")
+
+
 # --- CONTEXT PROCESSOR ---
 @app.context_processor
 def inject_global_data():
     """Makes 'settings' available in all templates automatically."""
     from datetime import datetime
-    return dict(settings=get_site_settings(), now=datetime.now())
+    manifest = get_asset_manifest()
+    return dict(settings=get_site_settings(), now=datetime.now(),
+                asset_bundle=manifest["css"] if manifest else None,
+                tailwind_config=TAILWIND_CONFIG,
+                google_fonts_url=GOOGLE_FONTS_URL,
+                font_awesome_url=FONT_AWESOME_URL)
 
 
 # --- AUTH ROUTES ---
@@ -198,7 +1439,11 @@ def logout():
 def admin_dashboard():
     all_pages = list(pages_collection.find())
     maintenance_active = is_maintenance_mode()
-    total_hits = analytics_collection.count_documents({"status_code": 200})
+    totals = list(analytics_collection.aggregate([
+        {"$match": {"status_code": 200}},
+        {"$group": {"_id": None, "hits": {"$sum": WEIGHT}}}
+    ]))
+    total_hits = round(totals[0]["hits"]) if totals else 0
     return render_template('admin.html',
                            pages=all_pages,
                            maintenance_active=maintenance_active,
@@ -216,6 +1461,7 @@ def update_settings():
     }
     settings_collection.update_one({"name": "global_config"}, {"$set": data},
                                    upsert=True)
+    bump_revision("settings")
     return redirect(url_for('admin_dashboard'))
 
 
@@ -254,6 +1500,7 @@ def add_nav_link():
         {"$push": {"nav_links": new_link}},
         upsert=True
     )
+    bump_revision("settings")
 
     return redirect(url_for('admin_dashboard'))
 
@@ -262,7 +1509,8 @@ def add_nav_link():
 @login_required
 def delete_nav_link(index):
     """Removes a nav link by its position in the array."""
-    settings = get_site_settings()
+    # Read straight from the DB so a stale cached list is never written back
+    settings = _load_site_settings()
     if "nav_links" in settings:
         links = settings["nav_links"]
         if 0 <= index < len(links):
@@ -271,16 +1519,18 @@ def delete_nav_link(index):
                                            {"$set": {
                                                "nav_links": links
                                            }})
+            bump_revision("settings")
     return redirect(url_for('admin_dashboard'))
 
 
 @app.route('/admin/toggle-maintenance')
 @login_required
 def toggle_maintenance():
-    current_status = is_maintenance_mode()
+    current_status = _load_maintenance_mode()
     settings_collection.update_one({"name": "maintenance_mode"},
                                    {"$set": {"active": not current_status}},
                                    upsert=True)
+    bump_revision("maintenance")
     return redirect(url_for('admin_dashboard'))
 
 # --------------------
@@ -483,7 +1733,8 @@ def trial_view(slug):
         'request': request,
         'datetime': datetime,
         'timedelta': timedelta,
-        'page': page
+        'page': page,
+        'bundle_covered': bundle_covers(page.get('content'), page.get('js'))
     }
 
     # For security: trial pages do NOT execute stored python logic
@@ -491,7 +1742,85 @@ def trial_view(slug):
     rendered_node_content = render_template_string(page.get('content', ''), **template_context)
     return render_template('page.html', rendered_node_content=rendered_node_content, **template_context)
 
-def render_preview_helper(content, css, js, logic, base_context=None):
+# --- PREVIEW SUBSYSTEM ---
+# Live previews are throttled per editor session with a token bucket, identical
+# payloads are served from a short-lived content-hash cache, and a render is
+# abandoned once a newer preview from the same editor has arrived.
+PREVIEW_RATE = 2.0        # tokens refilled per second
+PREVIEW_BURST = 10        # bucket capacity
+PREVIEW_CACHE_TTL = 30    # seconds
+PREVIEW_CACHE_MAX_ENTRIES = 128
+PREVIEW_MAX_EDITORS = 1024
+
+preview_buckets = {}
+preview_generations = {}
+preview_cache = {}
+preview_lock = threading.Lock()
+
+
+def _preview_editor_key():
+    """Identifies the editor session a preview request belongs to."""
+    if 'user' in session:
+        return f"admin:{session['user']}"
+    _ensure_trial_state()
+    return f"trial:{session['trial_seed']}"
+
+
+def _bounded_set(store, key, value, limit):
+    """Inserts into a dict used as a FIFO-bounded map."""
+    store.pop(key, None)
+    while len(store) >= limit:
+        store.pop(next(iter(store)))
+    store[key] = value
+
+
+def take_preview_token(editor):
+    """Consumes one token from the editor's bucket. False when the bucket is empty."""
+    now = datetime.now()
+    with preview_lock:
+        bucket = preview_buckets.get(editor) or {"tokens": float(PREVIEW_BURST), "updated": now}
+        elapsed = (now - bucket["updated"]).total_seconds()
+        bucket["tokens"] = min(PREVIEW_BURST, bucket["tokens"] + elapsed * PREVIEW_RATE)
+        bucket["updated"] = now
+        allowed = bucket["tokens"] >= 1
+        if allowed:
+            bucket["tokens"] -= 1
+        _bounded_set(preview_buckets, editor, bucket, PREVIEW_MAX_EDITORS)
+    return allowed
+
+
+def start_preview_generation(editor):
+    """Registers a new preview for the editor and returns its generation number."""
+    with preview_lock:
+        generation = preview_generations.get(editor, 0) + 1
+        _bounded_set(preview_generations, editor, generation, PREVIEW_MAX_EDITORS)
+    return generation
+
+
+def get_cached_preview(key):
+    """Returns a cached preview render for the payload hash, if still fresh."""
+    entry = preview_cache.get(key)
+    if entry and entry["expiry"] > datetime.now():
+        return entry["html"]
+    return None
+
+
+def store_cached_preview(key, html):
+    """Caches a preview render under its payload hash."""
+    with preview_lock:
+        _bounded_set(preview_cache, key, {"html": html, "expiry": datetime.now() + timedelta(seconds=PREVIEW_CACHE_TTL)},
+                     PREVIEW_CACHE_MAX_ENTRIES)
+
+
+def preview_stylesheet_tag(content, js):
+    """The built bundle when it covers the preview, otherwise the Tailwind CDN JIT."""
+    manifest = get_asset_manifest()
+    if manifest and bundle_covers(content, js):
+        return f'<link rel="stylesheet" href="{url_for("static", filename=manifest["css"])}">'
+    return '<script src="https://cdn.tailwindcss.com"></script>'
+
+
+def render_preview_helper(content, css, js, logic, base_context=None, is_cancelled=None):
     context = base_context if base_context else {}
     
     if logic:
@@ -518,7 +1847,7 @@ def render_preview_helper(content, css, js, logic, base_context=None):
                 .info-row {{ display: flex; gap: 20px; margin-bottom: 12px; font-size: 11px; }}
                 .info-label {{ color: #71717a; text-transform: uppercase; width: 80px; }}
                 .info-value {{ color: #e4e4e7; }}
-                .trace-block {{ margin-top: 12px; padding-top: 12px; border-top: 1px solid #18181b; color: #71717a; font-size: 10px; line-height: 1.6; white-space: pre-wrap; }}
+                .trace-block {{ margin-top: 12px; padding-top: 12px; border-top: 1px solid #18181b; color: #71717a; font-size: 10px; line-height: 1.6; white-space: pre-wrap; margin-bottom: 0; font-family: inherit; }}
             </style>
             <div class="error-wrapper">
                 <div class="error-card">
@@ -538,13 +1867,17 @@ def render_preview_helper(content, css, js, logic, base_context=None):
                                 <div><span class="info-label">Line:</span><span class="info-value">{line_no}</span></div>
                                 <div><span class="info-label">Scope:</span><span class="info-value">Logic Tab</span></div>
                             </div>
-                            <div class="trace-block">{full_trace.split('File "<string>", line', 1)[-1]}</div>
+                            <pre class="trace-block">{full_trace.split('File "<string>", line', 1)[-1]}</pre>
                         </div>
                     </div>
                 </div>
             </div>
             """
 
+    # A newer preview from the same editor supersedes this one
+    if is_cancelled and is_cancelled():
+        return None
+
     # Normal rendering logic (with fixed white bars)
     full_html = f"""
     <!DOCTYPE html>
@@ -552,7 +1885,7 @@ def render_preview_helper(content, css, js, logic, base_context=None):
     <head>
         <meta charset="UTF-8">
         <meta name="viewport" content="width=device-width,initial-scale=1">
-        <script src="https://cdn.tailwindcss.com"></script>
+        {preview_stylesheet_tag(content, js)}
         <style>
             html, body {{ background-color: #000; color: #a1a1aa; min-height: 100vh; margin: 0; padding: 0; }}
             ::-webkit-scrollbar {{ width: 10px; height: 10px; }}
@@ -606,13 +1939,36 @@ def preview_node():
 
     else:
         # Handling "Live Preview" (Editor-backed)
-        return render_preview_helper(
-            content=request.form.get('content', ''),
-            css=request.form.get('css', ''),
-            js=request.form.get('js', ''),
-            logic=request.form.get('python_logic', ''),
-            base_context=base_context
+        editor = _preview_editor_key()
+        if not take_preview_token(editor):
+            return "Preview rate limit exceeded", 429, {"Retry-After": str(max(1, int(1 / PREVIEW_RATE)))}
+
+        content = request.form.get('content', '')
+        css = request.form.get('css', '')
+        js = request.form.get('js', '')
+        # Trial sessions never execute Python logic, matching trial_view
+        logic = request.form.get('python_logic', '') if 'user' in session else ''
+
+        payload = json.dumps([editor, content, css, js, logic])
+        cache_key = hashlib.sha256(payload.encode()).hexdigest()
+        cached = get_cached_preview(cache_key)
+        if cached is not None:
+            return cached
+
+        generation = start_preview_generation(editor)
+        html = render_preview_helper(
+            content=content,
+            css=css,
+            js=js,
+            logic=logic,
+            base_context=base_context,
+            is_cancelled=lambda: preview_generations.get(editor) != generation
         )
+        if html is None:
+            return "Preview superseded", 409
+
+        store_cached_preview(cache_key, html)
+        return html
 
 @app.route('/admin/analytics')
 @login_required
@@ -666,32 +2022,12 @@ def admin_analytics():
     if 'path' in active_filters: base_filter['path'] = active_filters['path']
     if 'referrer' in active_filters: base_filter['referrer'] = active_filters['referrer']
 
-    # 5. DYNAMIC CHART PIPELINE
-    graph_pipeline = [
-        {"$match": base_filter},
-        {"$group": {
-            "_id": {"$dateToString": {"format": date_format, "date": "$timestamp"}},
-            "logs": {"$push": "$agent"},
-            "count": {"$sum": 1}
-        }},
-        {"$sort": {"_id": 1}}
-    ]
-    raw_results = list(analytics_collection.aggregate(graph_pipeline))
-
-    raw_graph_data = {}
-    for entry in raw_results:
-        key = entry['_id']
-        valid_count = 0
-        for agent in entry['logs']:
-            ua = parse(agent or '')
-            browser, os_family = ua.browser.family, ua.os.family
-            device = "Mobile" if ua.is_mobile else "Tablet" if ua.is_tablet else "Desktop"
-
-            if 'browser' in active_filters and active_filters['browser'] != browser: continue
-            if 'os' in active_filters and active_filters['os'] != os_family: continue
-            if 'device' in active_filters and active_filters['device'] != device: continue
-            valid_count += 1
-        raw_graph_data[key] = valid_count
+    # 5. SINGLE-PASS FACET QUERY
+    # browser/os/device are resolved in Python, so chip clicks on those reuse the cached facets
+    cache_key = (time_range, target_date, show_bots, active_filters.get('path'), active_filters.get('referrer'))
+    facets = get_dashboard_facets(cache_key, base_filter, date_format)
+    columns, agents = encode_analytics_columns(facets["rows"])
+    raw_graph_data, stats, filtered_logs_count = aggregate_analytics_columns(columns, agents, active_filters)
 
     # 6. GENERATE LABELS & VALUES
     chart_labels, chart_values = [], []
@@ -712,40 +2048,19 @@ def admin_analytics():
         chart_values.append(raw_graph_data.get(key, 0))
 
     # 7. AGGREGATE SIDEBAR STATS
-    unique_visitors = len(analytics_collection.distinct("visitor_hash", base_filter))
-    online_count = len(analytics_collection.distinct("visitor_hash", {"timestamp": {"$gt": now - timedelta(minutes=5)}}))
-
-    stats = {"browsers": {}, "os": {}, "devices": {}, "referrers": {}, "referrers_detailed": {}}
-    logs = list(analytics_collection.find(base_filter))
-
-    filtered_logs_count = 0
-    for log in logs:
-        ua = parse(log.get('agent') or '')
-        browser, os_family = ua.browser.family, ua.os.family
-        device = "Mobile" if ua.is_mobile else "Tablet" if ua.is_tablet else "Desktop"
-
-        if 'browser' in active_filters and active_filters['browser'] != browser: continue
-        if 'os' in active_filters and active_filters['os'] != os_family: continue
-        if 'device' in active_filters and active_filters['device'] != device: continue
-
-        filtered_logs_count += 1
-        stats["browsers"][browser] = stats["browsers"].get(browser, 0) + 1
-        stats["os"][os_family] = stats["os"].get(os_family, 0) + 1
-        stats["devices"][device] = stats["devices"].get(device, 0) + 1
-
-        ref_name = log.get('referrer', 'Direct Entry')
-        stats["referrers"][ref_name] = stats["referrers"].get(ref_name, 0) + 1
-        if ref_name not in stats["referrers_detailed"]:
-            stats["referrers_detailed"][ref_name] = {"count": 0, "url": log.get('full_referrer_url', '')}
-        stats["referrers_detailed"][ref_name]["count"] += 1
+    unique_visitors = facets["unique_visitors"]
+    online = list(analytics_collection.aggregate([
+        # Aggregated 404 counters carry no visitor_hash and are not visitors
+        {"$match": {"timestamp": {"$gt": now - timedelta(minutes=5)}, "visitor_hash": {"$exists": True}}},
+        {"$group": {"_id": "$visitor_hash", "weight": {"$max": WEIGHT}}},
+        {"$group": {"_id": None, "total": {"$sum": "$weight"}}}
+    ]))
+    online_count = round(online[0]["total"]) if online else 0
 
     # 8. TOP PAGES & ERRORS
-    top_pages = list(analytics_collection.aggregate([
-        {"$match": base_filter}, 
-        {"$group": {"_id": "$path", "count": {"$sum": 1}}}, 
-        {"$sort": {"count": -1}}, {"$limit": 8}
-    ]))
+    top_pages = facets["top_pages"]
 
+    flush_not_found_counts(force=True)
     error_logs = list(analytics_collection.find({
         "status_code": {"$gte": 400}, 
         "timestamp": {"$gte": start_date, "$lt": end_date}
@@ -786,6 +2101,281 @@ def admin_analytics():
                            add_filter=add_filter,
                            remove_filter=remove_filter)
 
+# --- PAGE REVISIONS ---
+# Every save is recorded in page_revisions, away from the live page document.
+# Most revisions are zlib-compressed line deltas against the previous one; a
+# full snapshot is written every REVISION_SNAPSHOT_EVERY revisions so any
+# revision rebuilds from at most that many deltas.
+REVISION_FIELDS = ("title", "content", "css", "js", "python_logic")
+REVISION_SNAPSHOT_EVERY = 10
+
+revision_indexes = {"ready": False}
+
+
+def _ensure_revision_indexes():
+    if not revision_indexes["ready"]:
+        revisions_collection.create_index([("slug", 1), ("rev", -1)], unique=True)
+        revision_indexes["ready"] = True
+
+
+def _encode_revision(payload):
+    return zlib.compress(json.dumps(payload).encode(), 9)
+
+
+def _decode_revision(blob):
+    return json.loads(zlib.decompress(blob).decode())
+
+
+def diff_fields(old, new):
+    """Line-level delta per field: ["=", i1, i2] copies old lines, ["+", text] inserts."""
+    delta = {}
+    for field in REVISION_FIELDS:
+        old_lines = (old.get(field) or '').splitlines(keepends=True)
+        new_lines = (new.get(field) or '').splitlines(keepends=True)
+        if old_lines == new_lines:
+            continue
+        ops = []
+        matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                ops.append(["=", i1, i2])
+            elif j2 > j1:
+                ops.append(["+", ''.join(new_lines[j1:j2])])
+        delta[field] = ops
+    return delta
+
+
+def apply_delta(old, delta):
+    """Rebuilds a revision's fields from its predecessor and a diff_fields delta."""
+    new = dict(old)
+    for field, ops in delta.items():
+        old_lines = (old.get(field) or '').splitlines(keepends=True)
+        parts = [''.join(old_lines[op[1]:op[2]]) if op[0] == "=" else op[1] for op in ops]
+        new[field] = ''.join(parts)
+    return new
+
+
+def load_revision(slug, rev=None):
+    """Reconstructs revision `rev` (latest when None) of a page, or None if missing."""
+    query = {"slug": slug}
+    if rev is not None:
+        query["rev"] = {"$lte": rev}
+    # Walk back to the nearest snapshot, then replay the deltas forward
+    chain = []
+    for doc in revisions_collection.find(query).sort("rev", -1):
+        if rev is not None and not chain and doc["rev"] != rev:
+            return None
+        chain.append(doc)
+        if doc["kind"] == "snapshot":
+            break
+    if not chain or chain[-1]["kind"] != "snapshot":
+        return None
+
+    fields = _decode_revision(chain[-1]["data"])
+    for doc in reversed(chain[:-1]):
+        fields = apply_delta(fields, _decode_revision(doc["data"]))
+    return {"rev": chain[0]["rev"], "created_at": chain[0]["created_at"], "fields": fields}
+
+
+def record_revision(slug, fields):
+    """Stores a page save as a delta (or periodic snapshot). Returns the revision number."""
+    _ensure_revision_indexes()
+    latest = load_revision(slug)
+    rev = latest["rev"] + 1 if latest else 1
+
+    delta = diff_fields(latest["fields"], fields) if latest else None
+    if latest and not delta:
+        return latest["rev"]
+    if latest and (rev - 1) % REVISION_SNAPSHOT_EVERY:
+        kind, payload = "delta", delta
+    else:
+        kind, payload = "snapshot", {field: fields.get(field) for field in REVISION_FIELDS}
+
+    revisions_collection.insert_one({
+        "slug": slug,
+        "rev": rev,
+        "kind": kind,
+        "created_at": datetime.now(),
+        "data": _encode_revision(payload)
+    })
+    return rev
+
+
+def seed_revision_history(page):
+    """Records a page's stored content as its first revision if it has no history yet."""
+    if page and not revisions_collection.find_one({"slug": page["slug"]}, {"_id": 1}):
+        record_revision(page["slug"], page)
+
+
+@app.route('/admin/revisions/<path:slug>')
+@login_required
+def page_revisions(slug):
+    """Lists a page's revisions, or returns one in full with ?rev=N."""
+    rev = request.args.get('rev', type=int)
+    if rev is not None:
+        revision = load_revision(slug, rev)
+        if not revision:
+            return {"error": "Revision not found"}, 404
+        return {"rev": revision["rev"], "created_at": revision["created_at"].isoformat(), **revision["fields"]}, 200
+
+    history = revisions_collection.find({"slug": slug}, {"data": 0, "_id": 0}).sort("rev", -1)
+    return {"slug": slug, "revisions": [
+        {"rev": r["rev"], "kind": r["kind"], "created_at": r["created_at"].isoformat()} for r in history
+    ]}, 200
+
+
+@app.route('/admin/rollback/<path:slug>', methods=['POST'])
+@login_required
+def rollback_page(slug):
+    """Restores a page to an earlier revision, recorded as a new revision."""
+    revision = load_revision(slug, request.form.get('rev', type=int))
+    if not revision:
+        abort(404)
+
+    data = {**revision["fields"], "updated_at": datetime.now()}
+    pages_collection.update_one({"slug": slug}, {"$set": data}, upsert=True)
+    try:
+        record_revision(slug, data)
+        index_page_text(pages_collection.find_one({"slug": slug}))
+    except Exception as e:
+        print(f"Revision/Search Index Error: {e}")
+    bump_revision("pages")
+    return redirect(url_for('edit_page', slug=slug))
+
+
+# --- PAGE SEARCH ---
+# Visible text is extracted from each page's Jinja/HTML at save time into
+# page_search, which carries a weighted Mongo text index. Queries hit the index
+# only; pages_collection is never scanned.
+SEARCH_RESULT_LIMIT = 10
+SEARCH_SNIPPET_RADIUS = 80
+SEARCH_REINDEX_BATCH = 500
+
+search_indexes = {"ready": False}
+JINJA_MARKUP = re.compile(r"\{%.*?%\}|\{\{.*?\}\}|\{#.*?#\}", re.DOTALL)
+INVISIBLE_BLOCKS = re.compile(r"<(script|style|template|noscript)\b.*?</\1\s*>", re.DOTALL | re.IGNORECASE)
+SEARCH_TAGS = re.compile(r"<[^>]+>")
+WHITESPACE = re.compile(r"\s+")
+
+
+def _ensure_search_indexes():
+    """Creates the search indexes once per process, backfilling pages the first time they are created."""
+    if not search_indexes["ready"]:
+        created = "page_text" not in search_collection.index_information()
+        search_collection.create_index([("title", "text"), ("text", "text")],
+                                       weights={"title": 5, "text": 1}, name="page_text")
+        search_collection.create_index("slug", unique=True)
+        search_indexes["ready"] = True
+        if created:
+            reindex_search()
+
+
+def extract_visible_text(content):
+    """Strips Jinja markup, invisible blocks and tags, leaving the readable text."""
+    text = JINJA_MARKUP.sub(" ", content or "")
+    text = INVISIBLE_BLOCKS.sub(" ", text)
+    text = SEARCH_TAGS.sub(" ", text)
+    return WHITESPACE.sub(" ", unescape_html(text)).strip()
+
+
+def search_index_operation(page):
+    """Builds the upsert that refreshes a page's searchable title and text."""
+    maint_val = page.get('maintenance', False)
+    return UpdateOne({"slug": page["slug"]}, {"$set": {
+        "slug": page["slug"],
+        "title": page.get("title") or "",
+        "text": extract_visible_text(page.get("content")),
+        "public": not ("admin" in page["slug"].lower() or "test" in page["slug"].lower() or
+                       (maint_val.lower() == "true" if isinstance(maint_val, str) else bool(maint_val)))
+    }}, upsert=True)
+
+
+def index_page_text(page):
+    """Upserts a page's searchable title and text."""
+    _ensure_search_indexes()
+    search_collection.bulk_write([search_index_operation(page)])
+
+
+def reindex_search():
+    """Rebuilds page_search from pages_collection in batches. Returns the number indexed."""
+    slugs, batch = [], []
+    for page in pages_collection.find({}, {"slug": 1, "title": 1, "content": 1, "maintenance": 1}):
+        if not page.get("slug"):
+            continue
+        batch.append(search_index_operation(page))
+        slugs.append(page["slug"])
+        if len(batch) >= SEARCH_REINDEX_BATCH:
+            search_collection.bulk_write(batch, ordered=False)
+            batch = []
+    if batch:
+        search_collection.bulk_write(batch, ordered=False)
+    search_collection.delete_many({"slug": {"$nin": slugs}})
+    return len(slugs)
+
+
+def _snippet(text, query):
+    """Returns the text around the first query term, or the opening of the text."""
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in query.lower().split() if term]
+    positions = [p for p in positions if p >= 0]
+    start = max(0, min(positions) - SEARCH_SNIPPET_RADIUS) if positions else 0
+    end = start + SEARCH_SNIPPET_RADIUS * 2
+    return ("…" if start else "") + text[start:end].strip() + ("…" if end < len(text) else "")
+
+
+def search_pages(query, public_only=True, limit=SEARCH_RESULT_LIMIT):
+    """Ranked text search over indexed pages with snippets."""
+    query = (query or "").strip()
+    if not query:
+        return []
+    _ensure_search_indexes()
+    match = {"$text": {"$search": query}}
+    if public_only:
+        match["public"] = True
+    cursor = search_collection.find(
+        match, {"_id": 0, "slug": 1, "title": 1, "text": 1, "score": {"$meta": "textScore"}}
+    ).sort([("score", {"$meta": "textScore"})]).limit(limit)
+    return [{
+        "slug": doc["slug"],
+        "url": "/" if doc["slug"] == "home" else f"/{doc['slug']}",
+        "title": doc["title"],
+        "score": round(doc["score"], 3),
+        "snippet": _snippet(doc["text"], query)
+    } for doc in cursor]
+
+
+@app.route('/_search')
+def public_search():
+    """Public page search, JSON results."""
+    # Pages are hidden behind a 503 during global maintenance, so is search
+    if is_maintenance_mode() and not ('user' in session and session.get('maintenance_bypass', False)):
+        return {"error": "Site under maintenance"}, 503
+    try:
+        return {"query": request.args.get('q', ''), "results": search_pages(request.args.get('q'))}, 200
+    except Exception as e:
+        print(f"Search Error: {e}")
+        return {"error": "Search unavailable"}, 503
+
+
+@app.route('/admin/api/search')
+@login_required
+def admin_search():
+    """Search across every page, including hidden and locked ones."""
+    try:
+        return {"query": request.args.get('q', ''), "results": search_pages(request.args.get('q'), public_only=False)}, 200
+    except OperationFailure as e:
+        print(f"Search Error: {e}")
+        return {"error": "Search unavailable"}, 503
+
+
+@app.route('/admin/api/search/reindex', methods=['POST'])
+@login_required
+def admin_search_reindex():
+    """Rebuilds the search index from pages_collection."""
+    _ensure_search_indexes()
+    return {"status": "success", "indexed": reindex_search()}, 200
+
+
 # --- PAGE EDITOR ---
 @app.route('/admin/edit/<path:slug>', methods=['GET', 'POST'])
 @login_required
@@ -800,7 +2390,31 @@ def edit_page(slug):
             "python_logic": request.form.get("python_logic"),
             "updated_at": datetime.now()
         }
+        # A rename must not land on another page or merge into its revision history
+        renamed = data["slug"] != slug
+        if renamed and (pages_collection.find_one({"slug": data["slug"]}, {"_id": 1})
+                        or revisions_collection.find_one({"slug": data["slug"]}, {"_id": 1})):
+            return {"error": f"Slug '{data['slug']}' is already in use"}, 409
+
+        # Content saved before revisions existed becomes rev 1, so it can be rolled back to
+        try:
+            seed_revision_history(pages_collection.find_one({"slug": slug}))
+        except Exception as e:
+            print(f"Revision Seed Error: {e}")
         pages_collection.update_one({"slug": slug}, {"$set": data}, upsert=True)
+
+        try:
+            # History follows the page when its slug is renamed
+            if renamed:
+                revisions_collection.update_many({"slug": slug}, {"$set": {"slug": data["slug"]}})
+                search_collection.delete_one({"slug": slug})
+            record_revision(data["slug"], data)
+            index_page_text(pages_collection.find_one({"slug": data["slug"]}))
+        except Exception as e:
+            print(f"Revision/Search Index Error: {e}")
+
+        schedule_asset_rebuild(data["content"], data["js"])
+        bump_revision("pages")
         return redirect(url_for('admin_dashboard'))
 
     page = pages_collection.find_one({"slug": slug})
@@ -825,6 +2439,9 @@ def edit_page(slug):
 @login_required
 def delete_page(slug):
     pages_collection.delete_one({"slug": slug})
+    revisions_collection.delete_many({"slug": slug})
+    search_collection.delete_one({"slug": slug})
+    bump_revision("pages")
     return redirect(url_for('admin_dashboard'))
 
 @app.route('/admin/bypass-maintenance')
@@ -835,6 +2452,180 @@ def bypass_maintenance():
     # Redirect back to the page they were trying to see
     return redirect(request.referrer or url_for('cms_router'))
 
+# --- RENDER PROFILER ---
+# A logged-in admin can profile one render of a slug with ?_profile=<token>
+# (see render_profile_signature; tokens expire after PROFILE_TOKEN_TTL) or by
+# toggling the slug in /admin/profiles, which profiles that slug's renders for
+# logged-in admins. Anonymous visitors are never profiled. A sampler thread
+# snapshots the rendering thread's stack every PROFILE_INTERVAL and stores
+# collapsed stacks ("a;b;c 12" per line) for flamegraph.pl or speedscope.
+# When neither trigger applies, rendering takes the plain path.
+PROFILE_INTERVAL = 0.002  # seconds
+PROFILE_HISTORY = 50
+PROFILE_TOKEN_TTL = 900  # seconds a ?_profile link stays valid
+
+
+@on_revision("profiling")
+def _drop_profiled_slugs_cache():
+    site_cache.pop("profiled_slugs", None)
+
+
+def _load_profiled_slugs():
+    config = settings_collection.find_one({"name": "render_profiling"}) or {}
+    return set(config.get("slugs", []))
+
+
+def render_profile_signature(slug, expires=None):
+    """Signed "<expires>.<mac>" token authorising profiled renders of `slug` until it expires."""
+    expires = expires or int(time.time()) + PROFILE_TOKEN_TTL
+    mac = hmac.new(app.secret_key.encode(), f"profile:{slug}:{expires}".encode(), hashlib.sha256).hexdigest()[:24]
+    return f"{expires}.{mac}"
+
+
+def should_profile_render(slug, is_admin):
+    """True for an admin with a valid, unexpired ?_profile token or viewing a toggled slug."""
+    if not is_admin:
+        return False
+    token = request.args.get('_profile')
+    if token:
+        expires, _, _ = token.partition(".")
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+        return hmac.compare_digest(token, render_profile_signature(slug, int(expires)))
+    try:
+        return slug in _cached_site_value("profiled_slugs", _load_profiled_slugs)
+    except Exception:
+        return False
+
+
+class RenderSampler:
+    """Statistical profiler sampling the calling thread's stack from a helper thread."""
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.duration_ms = (time.perf_counter() - self.started) * 1000
+        self.stopped.set()
+        self.sampler.join()
+        return False
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})".replace(";", ":"))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def save(self, slug):
+        """Stores the collapsed stacks, keeping the most recent PROFILE_HISTORY profiles."""
+        try:
+            profiles_collection.insert_one({
+                "slug": slug,
+                "created_at": datetime.now(),
+                "duration_ms": round(self.duration_ms, 2),
+                "samples": sum(self.stacks.values()),
+                "interval_ms": self.interval * 1000,
+                "collapsed": self.collapsed()
+            })
+            stale = [p["_id"] for p in profiles_collection.find({}, {"_id": 1}).sort("created_at", -1).skip(PROFILE_HISTORY)]
+            if stale:
+                profiles_collection.delete_many({"_id": {"$in": stale}})
+        except Exception as e:
+            print(f"Render Profile Error: {e}")
+
+
+@app.route('/admin/profiles')
+@login_required
+def admin_render_profiles():
+    """Recent render profiles, per-slug toggles and signed profiling links."""
+    profiles = list(profiles_collection.find({}, {"collapsed": 0}).sort("created_at", -1))
+    pages = [{
+        "slug": p["slug"],
+        "signature": render_profile_signature(p["slug"])
+    } for p in pages_collection.find({}, {"slug": 1}) if p.get("slug")]
+    return render_template('render_profiles.html', profiles=profiles, pages=pages,
+                           profiled_slugs=_load_profiled_slugs())
+
+
+@app.route('/admin/profiles/<profile_id>.txt')
+@login_required
+def render_profile_download(profile_id):
+    """Collapsed-stack output of one profile, ready for flamegraph.pl or speedscope."""
+    try:
+        profile = profiles_collection.find_one({"_id": ObjectId(profile_id)})
+    except Exception:
+        profile = None
+    if not profile:
+        abort(404)
+    return profile["collapsed"], 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
+@app.route('/admin/profile-toggle/<path:slug>')
+@login_required
+def toggle_render_profiling(slug):
+    """Turns admin-only render profiling on or off for a slug."""
+    op = "$pull" if slug in _load_profiled_slugs() else "$addToSet"
+    settings_collection.update_one({"name": "render_profiling"}, {op: {"slugs": slug}}, upsert=True)
+    bump_revision("profiling")
+    return redirect(url_for('admin_render_profiles'))
+
+
+def render_cms_page(path, page, maintenance_active=False):
+    """Runs a page's python_logic and renders it into page.html. Returns (html, PageData)."""
+    # Prepare context for the template and python_logic
+    page_data = PageData(path, budget=page.get('query_budget', PAGE_QUERY_BUDGET))
+    template_context = {
+        "db": BudgetedHandle(db, page_data),
+        "data": page_data,
+        "session": session, 
+        "request": request, 
+        "datetime": datetime, 
+        "timedelta": timedelta, 
+        "page": page,
+        "maintenance_active": maintenance_active, # Helpful for the UI badge
+        "bundle_covered": bundle_covers(page.get('content'), page.get('js'))
+    }
+    
+    # Every command issued from here on is charged to this page
+    profiler_state.page_data = page_data
+    try:
+        # Execute embedded Python logic
+        if page.get('python_logic'):
+            profiler_state.phase = "logic"
+            try:
+                # Execute in a specific dict to avoid global namespace pollution
+                exec_globals = {"template_context": template_context}
+                exec(page['python_logic'], exec_globals, template_context)
+            except Exception as e:
+                log_visit(path, 500)
+                template_context['logic_error'] = str(e)
+                template_context['error_traceback'] = traceback.format_exc()
+            finally:
+                profiler_state.phase = None
+
+        # Render final HTML
+        rendered_node_content = render_template_string(page.get('content', ''), **template_context)
+        return render_template('page.html', rendered_node_content=rendered_node_content, **template_context), page_data
+    finally:
+        profiler_state.page_data = None
+
 @app.route('/', defaults={'path': 'home'}, methods=['GET', 'POST'])
 @app.route('/<path:path>', methods=['GET', 'POST'])
 def cms_router(path):
@@ -855,6 +2646,11 @@ def cms_router(path):
         if not (is_admin and has_bypass):
             return render_template('503.html', maintenance_active=True), 503
 
+    # Known-missing slugs (scanner noise) skip the page lookup entirely
+    if is_known_missing(path):
+        log_not_found(path)
+        abort(404)
+
     try:
         # Fetch page from MongoDB
         page = pages_collection.find_one({"slug": path})
@@ -871,32 +2667,19 @@ def cms_router(path):
 
             # --- 4. RENDERING LOGIC ---
             log_visit(path, 200)
-            
-            # Prepare context for the template and python_logic
-            template_context = {
-                "db": db, 
-                "session": session, 
-                "request": request, 
-                "datetime": datetime, 
-                "timedelta": timedelta, 
-                "page": page,
-                "maintenance_active": global_maint or is_under_maint # Helpful for the UI badge
-            }
-            
-            # Execute embedded Python logic
-            if page.get('python_logic'):
-                try:
-                    # Execute in a specific dict to avoid global namespace pollution
-                    exec_globals = {"template_context": template_context}
-                    exec(page['python_logic'], exec_globals, template_context)
-                except Exception as e:
-                    log_visit(path, 500)
-                    template_context['logic_error'] = str(e)
-                    template_context['error_traceback'] = traceback.format_exc()
-
-            # Render final HTML
-            rendered_node_content = render_template_string(page.get('content', ''), **template_context)
-            return render_template('page.html', rendered_node_content=rendered_node_content, **template_context)
+            if should_profile_render(path, is_admin):
+                with RenderSampler() as sampler:
+                    html, page_data = render_cms_page(path, page, maintenance_active=global_maint or is_under_maint)
+                sampler.save(path)
+            else:
+                html, page_data = render_cms_page(path, page, maintenance_active=global_maint or is_under_maint)
+            response = make_response(html)
+
+            # Report DB usage to admins so expensive pages are easy to spot
+            if is_admin:
+                response.headers['X-Page-DB-Calls'] = str(page_data.db_calls)
+                response.headers['X-Page-Cache-Hits'] = str(page_data.cache_hits)
+            return response
             
     except (ConnectionFailure, ServerSelectionTimeoutError) as db_err:
         # TRUE DATABASE ERROR: Not a planned maintenance
@@ -910,9 +2693,55 @@ def cms_router(path):
         return render_template('503.html', maintenance_active=global_maint), 503
 
     # 404 FALLBACK
-    log_visit(path, 404)
+    remember_missing_slug(path)
+    log_not_found(path)
     abort(404)
 
+def fetch_og_screenshot(api_url):
+    """Fetches the homepage screenshot over the pooled session. Returns PNG bytes or None."""
+    try:
+        # Fetch with a real Browser User-Agent to avoid being blocked as a bot yourself
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+        }
+        response = http_session.get(api_url, timeout=(3.05, 20), headers=headers)
+        if response.status_code == 200:
+            return response.content
+    except Exception as e:
+        print(f"Screenshot Error: {e}")
+    return None
+
+def load_og_screenshot():
+    """Seeds this instance from the last screenshot stored in Mongo, once per process."""
+    og_cache["loaded"] = True
+    try:
+        doc = settings_collection.find_one({"name": "og_image"})
+        if doc and doc.get("image"):
+            og_cache["image"] = bytes(doc["image"])
+            og_cache["expiry"] = doc["fetched_at"] + OG_CACHE_TTL
+    except Exception as e:
+        print(f"Screenshot Load Error: {e}")
+
+
+def refresh_og_screenshot(api_url):
+    """Fetches a new screenshot and shares it through Mongo. Caller holds og_cache_lock."""
+    try:
+        image = fetch_og_screenshot(api_url)
+        if image:
+            og_cache["image"] = image
+            settings_collection.update_one(
+                {"name": "og_image"},
+                {"$set": {"image": image, "fetched_at": datetime.now()}},
+                upsert=True
+            )
+        og_cache["expiry"] = datetime.now() + (OG_CACHE_TTL if image else OG_RETRY_AFTER)
+    except Exception as e:
+        print(f"Screenshot Store Error: {e}")
+        og_cache["expiry"] = datetime.now() + OG_RETRY_AFTER
+    finally:
+        og_cache_lock.release()
+
+
 @app.route('/og-image.png')
 def dynamic_og_image():
     # 1. Target your live homepage with a 'bot' flag to skip modals/animations
@@ -930,22 +2759,24 @@ def dynamic_og_image():
     from urllib.parse import quote
     clean_title = quote(f"{site_title} | Portfolio")
 
-    try:
-        # 3. Fetch with a real Browser User-Agent to avoid being blocked as a bot yourself
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        }
-        response = requests.get(api_url, timeout=20, headers=headers)
-
-        if response.status_code == 200:
-            return send_file(
-                io.BytesIO(response.content),
-                mimetype='image/png',
-                download_name='og-image.png',
-                as_attachment=False # Changed to False so browsers/crawlers view it inline
-            )
-    except Exception as e:
-        print(f"Screenshot Error: {e}")
+    # 3. Serve the cached screenshot (shared across instances through Mongo). A stale
+    # or missing one is refreshed in the background; no request waits on Thum.io,
+    # they get the stale copy or the placeholder meanwhile.
+    if not og_cache["loaded"]:
+        load_og_screenshot()
+    if og_cache["expiry"] <= datetime.now() and og_cache_lock.acquire(blocking=False):
+        if og_cache["expiry"] <= datetime.now():
+            threading.Thread(target=refresh_og_screenshot, args=(api_url,), daemon=True).start()
+        else:
+            og_cache_lock.release()
+
+    if og_cache["image"]:
+        return send_file(
+            io.BytesIO(og_cache["image"]),
+            mimetype='image/png',
+            download_name='og-image.png',
+            as_attachment=False # Changed to False so browsers/crawlers view it inline
+        )
 
     # Fallback to placeholder
     return redirect(
@@ -970,7 +2801,7 @@ def sitemap():
         '/add_nav_link', '/delete_nav_link', '/toggle_maintenance',
         '/admin_analytics', '/edit_page', '/delete_page', '/sitemap',
         '/dynamic_og_image', '/robots_dot_txt', "/trial", "/_preview", 
-        "/trial/analytics", "/trial/toggle-maintenance",
+        "/trial/analytics", "/trial/toggle-maintenance", "/_search",
         "/og-image.png", "/robots.txt", "/sitemap.xml"
     ]
 
@@ -1044,6 +2875,7 @@ def update_settings_thing():
             {"$set": data},
             upsert=True
         )
+        bump_revision("settings")
         flash('Configuration updated successfully', 'success')
     except Exception as e:
         flash(f'System Error: {str(e)}', 'error')
@@ -1069,10 +2901,85 @@ def api_reorder_nav():
             {"$set": {"nav_links": data['nav_links']}},
             upsert=True
         )
+        bump_revision("settings")
         return {"status": "success"}, 200
     except Exception as e:
         return {"error": str(e)}, 500
 
+@app.route('/admin/api/traffic-rules', methods=['GET', 'POST'])
+@login_required
+def api_traffic_rules():
+    """Reads or replaces the bot signatures and referrer rules, with per-rule hit counters."""
+    if request.method == 'POST':
+        data = request.get_json()
+        if not data or not isinstance(data.get('bot_signatures', []), list) or not isinstance(data.get('referrer_rules', []), list):
+            return {"error": "Invalid data"}, 400
+        if not all(isinstance(x, str) and x for x in data.get('bot_signatures', [])):
+            return {"error": "bot_signatures must be non-empty strings"}, 400
+        if not all(isinstance(r, dict) and isinstance(r.get('match'), str) and r['match']
+                   and isinstance(r.get('label'), str) and r['label'] for r in data.get('referrer_rules', [])):
+            return {"error": "referrer_rules must be {match, label} objects"}, 400
+
+        update = {k: data[k] for k in ('bot_signatures', 'referrer_rules') if k in data}
+        try:
+            settings_collection.update_one({"name": "traffic_rules"}, {"$set": update}, upsert=True)
+            bump_revision("traffic")
+        except Exception as e:
+            return {"error": str(e)}, 500
+
+    classifier = get_traffic_classifier(force=request.method == 'POST')
+    return {
+        "bot_signatures": classifier["bot_rules"],
+        "referrer_rules": classifier["referrer_rules"],
+        "hits": dict(traffic_rule_hits)
+    }, 200
+
+
+@app.route('/admin/api/reclassify', methods=['POST'])
+@login_required
+def api_reclassify_traffic():
+    """Re-applies the current rules to historical analytics, one update per distinct value."""
+    get_traffic_classifier(force=True)
+    operations = []
+
+    # Bots: classify each distinct agent once and flip only the documents that disagree
+    agents = analytics_collection.aggregate([{"$group": {"_id": "$agent"}}], allowDiskUse=True)
+    for row in agents:
+        is_bot = classify_bot(row['_id'] or '', count=False)
+        operations.append(UpdateMany({"agent": row['_id'], "is_bot": {"$ne": is_bot}}, {"$set": {"is_bot": is_bot}}))
+
+    # Referrers: only bare hosts can be re-labelled, the raw URL is not stored
+    fixed_labels = {"Direct / Internal", "Direct Entry"}
+    referrers = analytics_collection.aggregate([{"$group": {"_id": "$referrer"}}], allowDiskUse=True)
+    for row in referrers:
+        source = row['_id']
+        if not source or source in fixed_labels or source.startswith("Campaign: "):
+            continue
+        label = classify_referrer(source, count=False)
+        if label != source:
+            operations.append(UpdateMany({"referrer": source}, {"$set": {"referrer": label}}))
+
+    try:
+        modified = analytics_collection.bulk_write(operations, ordered=False).modified_count if operations else 0
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+    analytics_cache.clear()
+    return {"status": "success", "modified": modified}, 200
+
+@app.route('/admin/db-profile')
+@login_required
+def admin_db_profile():
+    """DB call profile per route: totals, slow commands and N+1 patterns."""
+    return render_template('db_profile.html', profile=db_profile_snapshot(), enabled=DB_PROFILER_ENABLED)
+
+
+@app.route('/admin/api/db-profile')
+@login_required
+def api_db_profile():
+    """JSON dump of the DB profiler."""
+    return {"enabled": DB_PROFILER_ENABLED, **db_profile_snapshot()}, 200
+
 @app.errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
@@ -1082,5 +2989,310 @@ def service_unavailable(e):
     # Pass maintenance status to the template
     return render_template('503.html', maintenance_active=is_maintenance_mode()), 503
 
+# --- STATIC EXPORT ---
+# `flask --app api/index.py export-static` pre-renders every logic-free page
+# through render_cms_page into an output directory Vercel serves before the
+# /api/index rewrite. Pages with python_logic, content whose Jinja reads db,
+# data, session or request, per-page maintenance or a slug owned by a Flask
+# route stay dynamic. Exported pages bypass Flask, so they are not logged in
+# analytics. Only pages whose updated_at changed are
+# re-rendered, unless the site settings, templates or CSS bundle changed or
+# --full is passed. The build manifest lives outside the output directory so it
+# is never served. Static pages ignore global maintenance, so re-export (or
+# delete the output) when locking the site.
+EXPORT_MANIFEST = ".export-manifest.json"
+DYNAMIC_CONTEXT_NAMES = re.compile(r"\b(db|data|session|request)\b")
+
+
+def _export_target(out_dir, slug):
+    """Maps a slug to its clean-URL file path inside the export directory."""
+    if slug == 'home':
+        return os.path.join(out_dir, 'index.html')
+    return os.path.join(out_dir, *slug.split('/'), 'index.html')
+
+
+def _is_static_page(page):
+    """True if a page can be served as a pre-rendered file."""
+    slug = page.get('slug', '').strip('/')
+    if not slug or (page.get('python_logic') or '').strip():
+        return False
+    # Templates reading db, data, session or request differ per request or visitor
+    for expression in JINJA_EXPRESSIONS.findall(page.get('content') or ''):
+        if DYNAMIC_CONTEXT_NAMES.search(expression):
+            return False
+    maint_val = page.get('maintenance', False)
+    if maint_val.lower() == "true" if isinstance(maint_val, str) else bool(maint_val):
+        return False
+    # A file would shadow any Flask route sharing the URL
+    try:
+        endpoint, _ = app.url_map.bind('localhost').match('/' if slug == 'home' else f'/{slug}')
+        return endpoint == 'cms_router'
+    except Exception:
+        return False
+
+
+def _export_build_hash():
+    """Hash of everything besides page content that shapes rendered output."""
+    digest = hashlib.sha256(json.dumps(get_site_settings(), default=str, sort_keys=True).encode())
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    for root, dirs, files in os.walk(template_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, template_dir).encode())
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    manifest = get_asset_manifest()
+    digest.update((manifest["css"] if manifest else "").encode())
+    return digest.hexdigest()
+
+
+def _write_export_file(path, body):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(body)
+
+
+@app.cli.command("export-static")
+@click.option("--out", "out_dir", default="public", show_default=True, help="Output directory.")
+@click.option("--manifest", "manifest_path", default=EXPORT_MANIFEST, show_default=True,
+              help="Build manifest path, kept outside the output directory.")
+@click.option("--full", is_flag=True, help="Re-render every page regardless of updated_at.")
+def export_static(out_dir, manifest_path, full):
+    """Pre-render logic-free CMS pages, sitemap.xml and robots.txt.
+
+    Exported pages are served without reaching Flask, so their views are not
+    recorded by log_visit and do not appear in the analytics dashboard.
+    """
+    out_root = os.path.abspath(out_dir)
+    if os.path.commonpath([out_root, os.path.abspath(manifest_path)]) == out_root:
+        raise click.BadParameter("must be outside the output directory", param_hint="--manifest")
+
+    manifest = {"build": None, "pages": {}}
+    if not full and os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    build_hash = _export_build_hash()
+    if manifest.get("build") != build_hash:
+        manifest["pages"] = {}
+
+    rendered, skipped, exported = 0, 0, {}
+    for page in pages_collection.find():
+        slug = page.get('slug', '').strip('/')
+        if not _is_static_page(page):
+            continue
+
+        stamp = page['updated_at'].isoformat() if page.get('updated_at') else ''
+        exported[slug] = stamp
+        if manifest["pages"].get(slug) == stamp and os.path.exists(_export_target(out_dir, slug)):
+            skipped += 1
+            continue
+
+        # Render as an anonymous visitor through the same path cms_router uses
+        with app.test_request_context('/' if slug == 'home' else f'/{slug}'):
+            html, _ = render_cms_page(slug, page)
+        _write_export_file(_export_target(out_dir, slug), minify_html(html))
+        rendered += 1
+
+    # Remove pages that were deleted or turned dynamic since the last build
+    for slug in set(manifest["pages"]) - set(exported):
+        target = _export_target(out_dir, slug)
+        if os.path.exists(target):
+            os.remove(target)
+
+    with app.test_request_context('/sitemap.xml'):
+        _write_export_file(os.path.join(out_dir, 'sitemap.xml'), sitemap()[0])
+    with open(os.path.join(app.static_folder, 'robots.txt'), 'r') as f:
+        _write_export_file(os.path.join(out_dir, 'robots.txt'), f.read())
+
+    with open(manifest_path, 'w') as f:
+        json.dump({"build": build_hash, "pages": exported}, f, indent=2)
+    click.echo(f"Exported {rendered} page(s), {skipped} unchanged, to {out_dir}")
+
+
+# --- CONTENT ARCHIVES ---
+# Pages and settings move between environments as a zip holding pages.ndjson
+# and settings.ndjson (Extended JSON, one document per line). Export streams
+# from a cursor and import upserts in unordered batches, so memory stays flat
+# however many pages there are. Available as admin routes and CLI commands.
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_SPOOL_SIZE = 8 * 1024 * 1024  # uploads larger than this are spooled to disk
+ARCHIVE_SKIPPED_SETTINGS = ["cache_revisions", "og_image"]
+
+
+class _ChunkBuffer:
+    """Write-only sink that hands buffered zip output back to a generator."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+def stream_content_archive():
+    """Yields a zip archive of all pages and settings chunk by chunk."""
+    sink = _ChunkBuffer()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        sources = [
+            ("pages.ndjson", pages_collection.find({}, {"_id": 0}, batch_size=ARCHIVE_BATCH_SIZE)),
+            ("settings.ndjson", settings_collection.find({"name": {"$nin": ARCHIVE_SKIPPED_SETTINGS}}, {"_id": 0})),
+        ]
+        for name, cursor in sources:
+            with archive.open(name, mode="w", force_zip64=True) as member:
+                for doc in cursor:
+                    member.write(json_util.dumps(doc).encode() + b"\n")
+                    if sink.chunks:
+                        yield sink.drain()
+        manifest = {"exported_at": datetime.now().isoformat(), "format": 1}
+        archive.writestr("manifest.json", json.dumps(manifest))
+    yield sink.drain()
+
+
+def _read_ndjson(archive, name):
+    if name not in archive.namelist():
+        return
+    with archive.open(name) as member:
+        for line in member:
+            if line.strip():
+                yield json_util.loads(line)
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_content_archive(fileobj, dry_run=False):
+    """Upserts pages and settings from an archive, yielding a progress dict per batch.
+
+    Each batch reports which of its documents were (or, with dry_run, would
+    be) created or changed; the final dict only carries counts, so memory
+    stays flat however large the archive is.
+    """
+    totals = {"created": 0, "updated": 0, "unchanged": 0, "processed": 0}
+    with zipfile.ZipFile(fileobj) as archive:
+        targets = [
+            ("pages.ndjson", pages_collection, "slug", ()),
+            ("settings.ndjson", settings_collection, "name", ARCHIVE_SKIPPED_SETTINGS),
+        ]
+        for name, collection, key, skipped in targets:
+            for batch in _batched(_read_ndjson(archive, name), ARCHIVE_BATCH_SIZE):
+                batch = [doc for doc in batch if doc.get(key) and doc.get(key) not in skipped]
+                for doc in batch:
+                    doc.pop("_id", None)
+
+                # Diff against what is stored to classify each document
+                existing = {d[key]: d for d in collection.find({key: {"$in": [d[key] for d in batch]}}, {"_id": 0})}
+                created = [doc[key] for doc in batch if doc[key] not in existing]
+                updated = [doc[key] for doc in batch if doc[key] in existing and existing[doc[key]] != doc]
+                totals["created"] += len(created)
+                totals["updated"] += len(updated)
+                totals["unchanged"] += len(batch) - len(created) - len(updated)
+
+                if not dry_run and batch:
+                    if collection is pages_collection:
+                        # Pre-import content stays reachable through /admin/rollback
+                        for slug in updated:
+                            seed_revision_history(existing[slug])
+                    collection.bulk_write([UpdateOne({key: doc[key]}, {"$set": doc}, upsert=True) for doc in batch],
+                                          ordered=False)
+                    if collection is pages_collection:
+                        changed = set(created) | set(updated)
+                        for doc in batch:
+                            if doc[key] in changed:
+                                record_revision(doc[key], doc)
+                        _ensure_search_indexes()
+                        search_collection.bulk_write([search_index_operation(doc) for doc in batch], ordered=False)
+
+                totals["processed"] += len(batch)
+                yield {"file": name, "processed": totals["processed"], "created": created, "updated": updated}
+
+    if not dry_run:
+        bump_revision("pages", "settings", "maintenance", "traffic")
+    yield {"done": True, "dry_run": dry_run, "created": totals["created"], "updated": totals["updated"],
+           "unchanged": totals["unchanged"], "processed": totals["processed"]}
+
+
+@app.route('/admin/export')
+@login_required
+def export_content():
+    """Downloads every page and setting as a streamed zip archive."""
+    filename = f"portfolio-content-{datetime.now().strftime('%Y%m%d-%H%M%S')}.zip"
+    return Response(stream_with_context(stream_content_archive()), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+@app.route('/admin/import', methods=['POST'])
+@login_required
+def import_content():
+    """Imports an uploaded archive, streaming NDJSON progress. Pass dry_run=true to diff only."""
+    upload = request.files.get('archive')
+    if not upload:
+        return {"error": "No archive uploaded"}, 400
+    dry_run = request.form.get('dry_run') == 'true'
+
+    # Flask closes the upload once the view returns, before the body streams
+    archive = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE)
+    shutil.copyfileobj(upload.stream, archive)
+    archive.seek(0)
+
+    def progress():
+        try:
+            for update in import_content_archive(archive, dry_run=dry_run):
+                yield json.dumps(update) + "\n"
+        except (zipfile.BadZipFile, ValueError) as e:
+            yield json.dumps({"error": f"Invalid archive: {e}"}) + "\n"
+        except PyMongoError as e:
+            yield json.dumps({"error": f"Import failed: {e}"}) + "\n"
+        finally:
+            archive.close()
+
+    return Response(stream_with_context(progress()), mimetype='application/x-ndjson')
+
+
+@app.cli.command("export-content")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+def export_content_command(path):
+    """Write all pages and settings to a zip archive."""
+    with open(path, 'wb') as f:
+        for chunk in stream_content_archive():
+            f.write(chunk)
+    click.echo(f"Exported content to {path}")
+
+
+@app.cli.command("import-content")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--dry-run", is_flag=True, help="Report what would change without writing.")
+def import_content_command(path, dry_run):
+    """Upsert pages and settings from a zip archive."""
+    with open(path, 'rb') as f:
+        for update in import_content_archive(f, dry_run=dry_run):
+            if update.get("done"):
+                click.echo(f"{'Would import' if dry_run else 'Imported'} {update['processed']} document(s): "
+                           f"{update['created']} new, {update['updated']} changed, "
+                           f"{update['unchanged']} unchanged")
+            else:
+                click.echo(f"  {update['file']}: {update['processed']} processed")
+                for label in ("created", "updated"):
+                    for key in update[label]:
+                        click.echo(f"    {label}: {key}")
+
+
 if __name__ == '__main__':
     app.run(debug=True)
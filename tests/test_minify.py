@@ -0,0 +1,30 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+from index import minify_css, minify_html  # noqa: E402
+
+
+class MinifyHtmlTests(unittest.TestCase):
+    def test_attribute_values_are_preserved(self):
+        self.assertEqual(minify_html('<input value="a > b    c">'), '<input value="a > b    c">')
+        self.assertEqual(minify_html('<div data-x="a >   b" title="x    y">  hi  </div>'),
+                         '<div data-x="a >   b" title="x    y"> hi </div>')
+
+    def test_text_line_breaks_survive(self):
+        self.assertEqual(minify_html("<p>one\n      two</p>"), "<p>one\ntwo</p>")
+
+    def test_protected_blocks_are_untouched(self):
+        self.assertEqual(minify_html("<code>a    b</code>"), "<code>a    b</code>")
+
+
+class MinifyCssTests(unittest.TestCase):
+    def test_string_literals_are_preserved(self):
+        self.assertEqual(minify_css('.a::before { content: "a , b"; /* don\'t */ color: red ; }'),
+                         '.a::before{content:"a , b";color:red}')
+
+
+if __name__ == "__main__":
+    unittest.main()